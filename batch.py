@@ -0,0 +1,82 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Batch requests carry many independent expressions in one query line:
+#
+#   ;BATCH;2^3;<TAB>12+12;<TAB>integrate(x,x);
+#
+# A worker evaluates the expressions one after the other in the same
+# Maxima, following the reset policy between them. The reply contains the
+# reply of every expression in order, separated by lines which only
+# contain ;NEXT;. An expression which fails gets its own ;ERR; reply.
+
+import threading
+
+import maxima_threads
+
+BATCH_PREFIX = ';BATCH;'
+ITEM_SEPARATOR = '\t'
+REPLY_SEPARATOR = ';NEXT;'
+
+
+def parse_batch(request):
+    """Return the expressions of a batch request or None if the request
+    isn't a batch.
+    """
+    if not request.startswith(BATCH_PREFIX):
+        return None
+    return request[len(BATCH_PREFIX):].rstrip('\r\n').split(ITEM_SEPARATOR)
+
+
+def join_replies(replies):
+    """Return the reply of a batch from the replies of its parts"""
+    return ('\n' + REPLY_SEPARATOR + '\n').join(replies)
+
+
+def split_batch(controller, parts):
+    """Split a batch into at most parts smaller batches for different
+    workers. The reply of controller is set as soon as all of them are
+    done. Returns the RequestControllers of the smaller batches.
+    """
+    items = controller.items
+    size = -(-len(items) // parts)
+    subs = []
+    for start in range(0, len(items), size):
+        sub = maxima_threads.RequestController(controller.request)
+        sub.items = items[start:start + size]
+        sub.priority = controller.priority
+        sub.deadline = controller.deadline
+        sub.timeout = controller.timeout
+        sub.pool = controller.pool
+        subs.append(sub)
+
+    pending = [len(subs)]
+    lock = threading.Lock()
+    def _done(sub):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        controller.set_reply(join_replies([s.get_reply() for s in subs]))
+        controller.set_ready()
+
+    for sub in subs:
+        sub.add_done_callback(_done)
+    controller.set_on_cancel(lambda: [sub.cancel() for sub in subs])
+    return subs
@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+
+from maxima_threads import RequestController, RequestQueue
+from batch import parse_batch, join_replies, split_batch
+
+
+class BatchTests(unittest.TestCase):
+
+    def testParse(self):
+        self.assertEqual(parse_batch(';BATCH;2^3;\t12+12;\n'), ['2^3;', '12+12;'])
+        self.assertEqual(parse_batch('2^3;\n'), None)
+
+    def testJoin(self):
+        self.assertEqual(join_replies(['8', ';ERR;TIMEOUT']), '8\n;NEXT;\n;ERR;TIMEOUT')
+
+    def testSplit(self):
+        controller = RequestController(';BATCH;1;\t2;\t3;\t4;\t5;')
+        controller.items = parse_batch(controller.request)
+        parts = split_batch(controller, 2)
+        self.assertEqual([part.items for part in parts], [['1;', '2;', '3;'], ['4;', '5;']])
+
+        # The reply is ready as soon as all parts are done, in any order
+        for part in reversed(parts):
+            self.assertFalse(controller.is_ready())
+            part.set_reply(join_replies([item.rstrip(';') for item in part.items]))
+            part.set_ready()
+        self.assertTrue(controller.is_ready())
+        self.assertEqual(controller.get_reply(), join_replies(['1', '2', '3', '4', '5']))
+
+    def testCancelledParts(self):
+        controller = RequestController(';BATCH;1;\t2;\t3;\t4;')
+        controller.items = parse_batch(controller.request)
+        queries = RequestQueue()
+        for part in split_batch(controller, 2):
+            queries.put(part)
+        controller.cancel()
+        # Every expression gets an error of its own
+        self.assertTrue(controller.is_ready())
+        self.assertEqual(controller.get_reply(), join_replies([';ERR;CANCELLED'] * 4))
+
+    def testExpiredBatch(self):
+        controller = RequestController(';BATCH;1;\t2;\t3;')
+        controller.items = parse_batch(controller.request)
+        controller.deadline = time.monotonic() - 1
+        queries = RequestQueue()
+        queries.put(controller)
+        queries.put(RequestController('4;'))
+        self.assertEqual(queries.get_request(threading.Event()).request, '4;')
+        self.assertEqual(controller.get_reply(), join_replies([';ERR;EXPIRED'] * 3))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+#! env python
+
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Benchmarks for tcp2maxima. They use fake_maxima.py instead of a real
+# Maxima, so the numbers show the overhead of tcp2maxima itself.
+#
+# The server benchmark runs the whole TCP server with a pool of fake
+# Maximas in a child process and sends queries from a number of client
+# threads. The results can be saved as a JSON baseline and later runs
+# compared against it:
+#
+#   ./benchmark.py server --save baseline.json
+#   ./benchmark.py server --compare baseline.json
+#
+# The startup benchmark compares booting the workers of a pool one after
+# another, like tcp2maxima did before, with booting them at the same time.
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+from maxima_process import MaximaProcess
+from maxima_threads import MaximaWorker, RequestController, RequestQueue
+from replyparser import ReplyParser
+
+FAKE_MAXIMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_maxima.py')
+
+# A result is a regression if it's that much worse than the baseline
+TOLERANCE = 0.2
+
+# Unit of the CPU times in /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def fake_config(**keys):
+    """Return a [Maxima] configuration which uses the fake Maxima"""
+    cfg = {'path': FAKE_MAXIMA,
+           'threads': '1',
+           'timeout': '10',
+           'init': 'reset()$kill(all)$display2d:false$linel:10000$',
+           'reset': 'reset()$kill(all)$display2d:false$linel:10000$'}
+    cfg.update(keys)
+    return cfg
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(latencies):
+    """Return the latency percentiles in milliseconds"""
+    return {'count': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000}
+
+
+def report(name, latencies):
+    result = summary(latencies)
+    print("%-12s n=%-6d p50=%8.2fms p95=%8.2fms p99=%8.2fms max=%8.2fms" %
+          (name, result['count'], result['p50_ms'], result['p95_ms'],
+           result['p99_ms'], result['max_ms']))
+    return result
+
+
+def bench_latency(count, query='12+12;', **keys):
+    """Send count queries one after another to a single worker and
+    measure the time until every reply is ready.
+    """
+    queries = RequestQueue()
+    worker = MaximaWorker('bench', queries, fake_config(**keys))
+    worker.daemon = True
+    worker.start()
+
+    latencies = []
+    try:
+        for i in range(count):
+            controller = RequestController(query)
+            start = time.monotonic()
+            queries.put(controller)
+            controller.wait()
+            latencies.append(time.monotonic() - start)
+    finally:
+        worker.quit_worker()
+        worker.join()
+    return latencies
+
+
+def bench_parser(megabytes, line_length=10000, chunk=65536):
+    """Feed a reply of the given size to the parser in chunks like they
+    come from the pipe. Returns the seconds needed.
+    """
+    line = b'x' * line_length
+    count = max(1, megabytes * 1024 * 1024 // (line_length + 8))
+    data = b''.join(b'(%o' + bytes(str(i), 'ascii') + b') ' + line + b'\n'
+                    for i in range(count)) + b'(%i1) '
+
+    parser = ReplyParser('bench')
+    view = memoryview(data)
+    start = time.monotonic()
+    for offset in range(0, len(data), chunk):
+        parser.feed(view[offset:offset + chunk])
+    reply = parser.reply()
+    elapsed = time.monotonic() - start
+    assert parser.ready and len(reply) >= count * line_length
+    return elapsed
+
+
+def bench_startup(workers, boot):
+    """Boot workers fake Maximas which need boot seconds each. Returns the
+    seconds until the first and until all of them are ready, for booting
+    them one after another and at the same time.
+    """
+    from maxima_pool import MaximaPool
+    os.environ['FAKE_MAXIMA_BOOT'] = str(boot)
+    cfg = fake_config(threads=str(workers))
+    result = {}
+    try:
+        # The old way: every process is initialized before the next is started
+        start = time.monotonic()
+        processes = []
+        for i in range(workers):
+            process = MaximaProcess(i, cfg)
+            process.start()
+            processes.append(process)
+            if i == 0:
+                result['sequential_first_s'] = time.monotonic() - start
+        result['sequential_all_s'] = time.monotonic() - start
+        for process in processes:
+            process.terminate()
+
+        # The pool boots all workers at the same time
+        start = time.monotonic()
+        pool = MaximaPool(RequestQueue(), cfg)
+        pool.start_workers()
+        pool.wait_ready(1)
+        result['parallel_first_s'] = time.monotonic() - start
+        pool.wait_ready(workers)
+        result['parallel_all_s'] = time.monotonic() - start
+        pool.quit()
+    finally:
+        del os.environ['FAKE_MAXIMA_BOOT']
+    return result
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _maxima_cpu_time(pool):
+    """Return the CPU time the running Maxima processes of a pool used so
+    far, read from /proc. A process which is gone counts as 0.
+    """
+    total = 0.0
+    for worker in pool.workers:
+        try:
+            with open('/proc/%d/stat' % worker.maxima.process.pid) as f:
+                # The fields after the name, utime and stime are 14 and 15
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return total
+
+
+def _serve(mode, workers, fake, connection):
+    """Run the TCP server with a pool of fake Maximas until we're told
+    to stop. Runs in a child process, so its CPU time can be measured.
+    """
+    from maxima_pool import MaximaPool
+    from tcp_server import ThreadedTCPServer, AsyncTCPServer, RequestHandler
+
+    # The fake Maximas read their options from the environment
+    for key, value in fake.items():
+        os.environ['FAKE_MAXIMA_' + key.upper()] = str(value)
+
+    queries = RequestQueue()
+    pool = MaximaPool(queries, fake_config(threads=str(workers)))
+    pool.start_workers()
+    pool.wait_ready(workers)
+
+    if mode == 'asyncio':
+        server = AsyncTCPServer(('localhost', 0), queries.put)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.started.wait()
+        port = server.server.sockets[0].getsockname()[1]
+    else:
+        get_handler = lambda *args, **keys: RequestHandler(queries.put, *args, **keys)
+        server = ThreadedTCPServer(('localhost', 0), get_handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+
+    connection.send(port)
+    # Measure the CPU time of the queries only, not of the startup
+    start = _cpu_time(resource.RUSAGE_SELF)
+    maxima_start = _maxima_cpu_time(pool)
+    connection.recv()
+    server_cpu = _cpu_time(resource.RUSAGE_SELF) - start
+    # The fake Maximas don't time out, so they are the same processes
+    maxima_cpu = _maxima_cpu_time(pool) - maxima_start
+    server.shutdown()
+    pool.quit()
+    connection.send((server_cpu, maxima_cpu))
+
+
+def _query(port, query):
+    client = socket.create_connection(('localhost', port))
+    client.sendall(bytes(query + '\n', 'UTF-8'))
+    reply = b''
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        reply += chunk
+    client.close()
+    return reply
+
+
+def bench_server(count, concurrency, workers, mode='threading', query='12+12;', **fake):
+    """Send count queries from concurrency clients to a TCP server with
+    workers fake Maximas. fake are options for fake_maxima.py, e.g. delay.
+    """
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(mode, workers, fake, child))
+    server.start()
+    port = parent.recv()
+
+    latencies = []
+    lock = threading.Lock()
+    def _client(n):
+        mine = []
+        for i in range(n):
+            start = time.monotonic()
+            _query(port, query)
+            mine.append(time.monotonic() - start)
+        with lock:
+            latencies.extend(mine)
+
+    clients = [threading.Thread(target=_client, args=(count // concurrency,))
+               for i in range(concurrency)]
+    start = time.monotonic()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - start
+
+    parent.send('stop')
+    server_cpu, maxima_cpu = parent.recv()
+    server.join()
+
+    result = summary(latencies)
+    result.update({'throughput_qps': len(latencies) / elapsed,
+                   'cpu_ms_per_query': server_cpu / len(latencies) * 1000,
+                   'maxima_cpu_ms_per_query': maxima_cpu / len(latencies) * 1000})
+    return result
+
+
+def run_server_benchmarks(args):
+    results = {}
+    for mode in args.modes:
+        for workers in args.workers:
+            for concurrency in args.concurrency:
+                name = '%s-w%d-c%d' % (mode, workers, concurrency)
+                result = bench_server(args.count, concurrency, workers, mode,
+                                      delay=args.delay, size=args.size, chunks=args.chunks)
+                results[name] = result
+                print("%-22s %8.0f q/s p50=%7.2fms p95=%7.2fms p99=%7.2fms cpu=%6.3fms/q "
+                      "maxima=%6.3fms/q" %
+                      (name, result['throughput_qps'], result['p50_ms'], result['p95_ms'],
+                       result['p99_ms'], result['cpu_ms_per_query'],
+                       result['maxima_cpu_ms_per_query']))
+    return results
+
+
+def compare(results, baseline):
+    """Print the changes against a baseline and return the number of
+    regressions.
+    """
+    regressions = 0
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        for key in ('throughput_qps', 'p50_ms', 'p95_ms', 'p99_ms', 'cpu_ms_per_query',
+                    'maxima_cpu_ms_per_query', 'parallel_first_s', 'parallel_all_s'):
+            if not old.get(key):
+                continue
+            change = (result[key] - old[key]) / old[key]
+            # Only for the throughput more is better
+            worse = -change if key == 'throughput_qps' else change
+            flag = ''
+            if worse > TOLERANCE:
+                flag = '  REGRESSION'
+                regressions += 1
+            print("%-22s %-18s %10.3f -> %10.3f %+6.1f%%%s" %
+                  (name, key, old[key], result[key], change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for tcp2maxima.')
+    parser.add_argument('benchmark', nargs='?', default='latency',
+                        choices=['latency', 'server', 'parser', 'startup'],
+                        help="latency of a single worker, the whole TCP server, the reply parser "
+                             "or the startup of a pool")
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help="number of queries per benchmark")
+    parser.add_argument('-r', '--reset-policy', default='always',
+                        choices=['always', 'on-mutation', 'every'],
+                        help="reset policy of the workers")
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help="numbers of concurrent clients")
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        help="pool sizes, 1 4 for the server and 8 16 32 for the startup benchmark")
+    parser.add_argument('-m', '--modes', nargs='+', default=['threading', 'asyncio'],
+                        choices=['threading', 'asyncio'], help="server modes")
+    parser.add_argument('--delay', type=float, default=0,
+                        help="seconds the fake Maxima needs per statement")
+    parser.add_argument('--size', type=int, default=0,
+                        help="size of the fake Maxima replies")
+    parser.add_argument('--chunks', type=int, default=1,
+                        help="number of writes the fake Maxima needs per reply")
+    parser.add_argument('--boot', type=float, default=0.5,
+                        help="seconds the fake Maxima needs to boot in the startup benchmark")
+    parser.add_argument('--save', help="save the results as JSON baseline to this file")
+    parser.add_argument('--compare', help="compare the results to the JSON baseline in this file")
+    args = parser.parse_args()
+
+    if args.benchmark == 'latency':
+        results = {'latency': report('latency', bench_latency(args.count, reset_policy=args.reset_policy))}
+    elif args.benchmark == 'parser':
+        results = {}
+        for megabytes in (1, 4, 16):
+            for line_length in (80, 10000, megabytes * 1024 * 1024):
+                elapsed = bench_parser(megabytes, line_length)
+                name = 'parser-%dmb-l%d' % (megabytes, line_length)
+                results[name] = {'seconds': elapsed, 'mb_per_second': megabytes / elapsed}
+                print("%-26s %8.3f s %8.1f MB/s" % (name, elapsed, megabytes / elapsed))
+    elif args.benchmark == 'startup':
+        results = {}
+        for workers in args.workers or [8, 16, 32]:
+            name = 'startup-w%d' % workers
+            results[name] = result = bench_startup(workers, args.boot)
+            print("%-14s sequential: first %6.2f s, all %6.2f s   parallel: first %6.2f s, all %6.2f s" %
+                  (name, result['sequential_first_s'], result['sequential_all_s'],
+                   result['parallel_first_s'], result['parallel_all_s']))
+    else:
+        args.workers = args.workers or [1, 4]
+        results = run_server_benchmarks(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)):
+                sys.exit(1)
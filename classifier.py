@@ -0,0 +1,99 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Decides which requests are processed by the slow pool of Maxima
+# workers, so runaway computations don't hold up the cheap ones.
+
+import collections
+import re
+import threading
+
+FAST = 'fast'
+SLOW = 'slow'
+
+# A power of a power like 12^12^12^12 or x^(y^z)
+TOWER_RE = re.compile(r"\^\s*\(*\s*[\w.%]+\s*\^")
+# Functions which can take a long time on larger inputs
+HEAVY_RE = re.compile(r"\b(integrate|risch|defint|solve|algsys|to_poly_solve|factor|ifactors|"
+                      r"ode2|desolve|limit|taylor|powerseries|sum|product|eigenvalues)\s*\(")
+# Numbers are replaced by their number of digits in the shape of a request
+NUMBER_RE = re.compile(r"\d+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+# Weight of a new observation in the average runtime of a shape
+RUNTIME_WEIGHT = 0.5
+
+
+class RequestClassifier:
+    """ Classifies requests as FAST or SLOW. A request is slow if it
+    contains an exponent tower, if it's longer than max_length or if it
+    calls one of the heavy functions and is longer than heavy_length.
+
+    The classifier learns from the runtimes of the requests: If the
+    requests of a shape took longer than slow_runtime seconds on average,
+    requests of that shape are slow, otherwise they are fast, whatever
+    the rules above say. The shape of a request is the request with every
+    number replaced by its number of digits. At most size shapes are
+    remembered, the least recently used ones are forgotten.
+    """
+
+    def __init__(self, max_length=2000, heavy_length=200, slow_runtime=1.0, size=10000):
+        self.max_length = max_length
+        self.heavy_length = heavy_length
+        self.slow_runtime = slow_runtime
+        self.size = size
+        # Maps shapes to their average runtime in LRU order
+        self.runtimes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def shape(self, request):
+        request = WHITESPACE_RE.sub('', request)
+        return NUMBER_RE.sub(lambda match: '#%d' % len(match.group(0)), request)
+
+    def classify(self, request):
+        """Return FAST or SLOW"""
+        shape = self.shape(request)
+        with self.lock:
+            runtime = self.runtimes.get(shape)
+            if runtime is not None:
+                self.runtimes.move_to_end(shape)
+        if runtime is not None:
+            return SLOW if runtime > self.slow_runtime else FAST
+
+        if TOWER_RE.search(request) or len(request) > self.max_length:
+            return SLOW
+        if len(request) > self.heavy_length and HEAVY_RE.search(request):
+            return SLOW
+        return FAST
+
+    def observe(self, request, seconds):
+        """Called with the time Maxima needed for a request"""
+        shape = self.shape(request)
+        with self.lock:
+            runtime = self.runtimes.get(shape)
+            if runtime is not None:
+                seconds = runtime + RUNTIME_WEIGHT * (seconds - runtime)
+            self.runtimes[shape] = seconds
+            self.runtimes.move_to_end(shape)
+            while len(self.runtimes) > self.size:
+                self.runtimes.popitem(last=False)
+
+    def __len__(self):
+        return len(self.runtimes)
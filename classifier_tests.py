@@ -0,0 +1,47 @@
+import unittest
+
+from classifier import RequestClassifier, FAST, SLOW
+
+
+class RequestClassifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = RequestClassifier(max_length=100, heavy_length=20, slow_runtime=1, size=2)
+
+    def testRules(self):
+        self.assertTrue(self.classifier.classify('12+12;') == FAST)
+        self.assertTrue(self.classifier.classify('x^2+y^2;') == FAST)
+        self.assertTrue(self.classifier.classify('12^12^12^12;') == SLOW)
+        self.assertTrue(self.classifier.classify('x^(y^z);') == SLOW)
+        self.assertTrue(self.classifier.classify('1+' * 60 + '1;') == SLOW)
+        # Heavy functions are only slow on larger inputs
+        self.assertTrue(self.classifier.classify('factor(12);') == FAST)
+        self.assertTrue(self.classifier.classify('factor(12345678901234567890);') == SLOW)
+        self.assertTrue(self.classifier.classify('x+y+12345678901234567890;') == FAST)
+
+    def testLearning(self):
+        self.classifier.observe('factor(2^64-1);', 3)
+        self.assertTrue(self.classifier.classify('factor(2^64-1);') == SLOW)
+        # Numbers with the same number of digits have the same shape
+        self.assertTrue(self.classifier.classify('factor(3^64 - 1);') == SLOW)
+        self.assertTrue(self.classifier.classify('factor(3^640-1);') == FAST)
+
+        # A tower which turned out to be fast
+        self.classifier.observe('2^3^2;', 0.01)
+        self.assertTrue(self.classifier.classify('2^3^2;') == FAST)
+
+        # The average goes down with faster runs
+        self.classifier.observe('factor(2^64-1);', 0.1)
+        self.classifier.observe('factor(2^64-1);', 0.1)
+        self.assertTrue(self.classifier.classify('factor(2^64-1);') == FAST)
+
+        # The least recently used shape is forgotten
+        self.classifier.observe('integrate(x,x);', 5)
+        self.assertTrue(len(self.classifier) == 2)
+        self.assertTrue(self.classifier.classify('2^3^2;') == SLOW)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
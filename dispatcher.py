@@ -0,0 +1,234 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import math
+import time
+
+import batch
+import metrics
+from classifier import RequestClassifier, SLOW
+from maxima_threads import RequestQueue, ERROR_BUSY
+from requestfilter import RequestFilter, split_options
+from result_cache import ResultCache, SingleFlight
+
+logger = logging.getLogger("tcp2maxima")
+
+
+def parse_seconds(value):
+    """Return the number of seconds a client asked for, or None unless
+    it's a finite number above 0.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(seconds) or seconds <= 0:
+        return None
+    return seconds
+
+
+class Dispatcher:
+    """ Decides what happens to the requests of the TCP server: They are
+    answered from the cache, attached to an identical request in flight,
+    rejected because we're overloaded or put into the queue of a pool.
+
+    The queues are created here, the pools working on them are set by
+    the application once they are started: pool for the default queue,
+    slow_pool for slow_queries and the named pools in pools.
+    """
+
+    def __init__(self, config):
+        srvcfg = config['Server']
+        self.mxcfg = config['Maxima']
+
+        # Queue used to send request to the maxima instances
+        self.queries = RequestQueue(priorities=srvcfg.get('priorities', 'default').split(),
+                                    default_priority=srvcfg.get('default_priority', 'default'))
+        self.batch_priority = srvcfg.get('batch_priority', self.queries.default_priority)
+        # Requests are rejected if more than max_queue requests are queued
+        # or a new one would probably wait longer than max_wait seconds.
+        # 0 means there is no limit.
+        self.max_queue = int(srvcfg.get('max_queue', 0))
+        self.max_wait = float(srvcfg.get('max_wait', 0))
+        self.rejected = dict((reason, metrics.REGISTRY.counter('tcp2maxima_rejected_total',
+                                                               'Requests rejected with ;ERR;BUSY',
+                                                               labels={'reason': reason}))
+                             for reason in ('queue', 'wait'))
+        # Clients may ask for a longer or shorter timeout, up to max_timeout
+        self.max_timeout = float(self.mxcfg.get('max_timeout', self.mxcfg['timeout']))
+
+        # With slow_threads, requests the classifier considers slow and
+        # requests which timed out are processed by a pool of their own
+        self.slow_threads = int(self.mxcfg.get('slow_threads', 0))
+        self.slow_queries = None
+        if self.slow_threads > 0:
+            self.slow_queries = RequestQueue(priorities=self.queries.priorities,
+                                             default_priority=self.queries.default_priority)
+        self.classifier = RequestClassifier(max_length=int(self.mxcfg.get('slow_length', 2000)),
+                                            heavy_length=int(self.mxcfg.get('heavy_length', 200)),
+                                            slow_runtime=float(self.mxcfg.get('slow_runtime', 1)))
+        self.pool = None
+        self.slow_pool = None
+        self.pools = {}
+
+        # Cache for the replies of frequent queries
+        cachecfg = config['Cache']
+        self.fltr = RequestFilter()
+        self.cache = ResultCache(int(cachecfg['size']), float(cachecfg['ttl']))
+        # Identical requests in flight at the same time share one reply
+        self.coalesce = cachecfg.getboolean('coalesce', False)
+        self.inflight = SingleFlight()
+
+        # Batches are split into parts of at least this many expressions
+        # if there are idle workers, 0 means they are never split
+        self.batch_split_size = int(srvcfg.get('batch_split_size', 0))
+
+        metrics.REGISTRY.gauge('tcp2maxima_cache_hits_total', 'Requests answered from the cache',
+                               lambda: self.cache.hits, kind='counter')
+        metrics.REGISTRY.gauge('tcp2maxima_cache_misses_total', 'Requests not found in the cache',
+                               lambda: self.cache.misses, kind='counter')
+        metrics.REGISTRY.gauge('tcp2maxima_coalesced_total', 'Requests which got the reply of an identical request',
+                               lambda: self.inflight.coalesced, kind='counter')
+
+    def dispatch(self, controller):
+        """Callback of the TCP server. Answers a request from the cache,
+        attaches it to an identical request in flight or puts it into
+        the queue for the Maxima workers.
+        """
+        self.apply_options(controller)
+        items = batch.parse_batch(controller.request)
+        if items is not None:
+            if controller.priority is None:
+                controller.priority = self.batch_priority
+            self.dispatch_batch(controller, items)
+            return
+
+        if self.cache.size <= 0 and not self.coalesce:
+            self.enqueue(controller)
+            return
+
+        request = self.fltr.filter(controller.request)
+        if controller.pool is not None:
+            # Another pool may give another reply
+            request = controller.pool + ':' + request
+        if self.cache.size > 0:
+            reply = self.cache.get(request)
+            if reply is not None:
+                controller.set_reply(reply)
+                controller.set_ready()
+                return
+
+        if self.coalesce and self.inflight.join(request, controller):
+            return
+
+        if self.cache.size > 0:
+            controller.add_done_callback(lambda c: self.cache.put(request, c.get_reply()))
+        self.enqueue(controller)
+
+    def apply_options(self, controller):
+        """Remove the options from the request and set the priority class,
+        deadline, timeout and pool of the controller.
+        """
+        options, controller.request = split_options(controller.request)
+        controller.priority = options.get('priority')
+        if 'pool' in options:
+            if options['pool'] in self.pools:
+                controller.pool = options['pool']
+            else:
+                logger.warn("Ignoring unknown pool " + options['pool'])
+        if 'deadline' in options:
+            deadline = parse_seconds(options['deadline'])
+            if deadline is None:
+                logger.warn("Ignoring invalid deadline " + options['deadline'])
+            else:
+                controller.deadline = time.monotonic() + deadline
+        if 'timeout' in options:
+            timeout = parse_seconds(options['timeout'])
+            if timeout is None:
+                logger.warn("Ignoring invalid timeout " + options['timeout'])
+            else:
+                controller.timeout = min(timeout, self.max_timeout)
+
+    def dispatch_batch(self, controller, items):
+        """Put a batch request into the queue. If some workers are idle,
+        the batch is split into parts which are processed at the same time.
+        """
+        controller.items = items
+        queries, pool = self.route(controller)
+        parts = 1
+        if self.batch_split_size > 0:
+            idle = pool.idle_workers() - queries.qsize()
+            parts = min(idle, len(items) // self.batch_split_size)
+        if parts < 2:
+            self.enqueue(controller)
+            return
+        if not self.admit(controller, queries, pool):
+            return
+        pool.requests.inc()
+        for part in batch.split_batch(controller, parts):
+            queries.put(part)
+
+    def route(self, controller):
+        """Return the queue and the pool for a request: The named pool it
+        asked for, or the default or the slow pool.
+        """
+        if controller.pool is not None:
+            pool = self.pools[controller.pool]
+            return pool.queries, pool
+        if self.slow_queries is None:
+            return self.queries, self.pool
+        # A request which may compute longer than the fast pool allows
+        if controller.timeout is not None and controller.timeout > float(self.mxcfg['timeout']):
+            return self.slow_queries, self.slow_pool
+        request = '$'.join(controller.items) if controller.items is not None else controller.request
+        if self.classifier.classify(request) == SLOW:
+            return self.slow_queries, self.slow_pool
+        return self.queries, self.pool
+
+    def observe(self, controller):
+        """Teach the classifier how long a request took"""
+        # Requests which expired in the queue or were cancelled don't tell
+        if controller.items is None and not controller.cancelled and controller.runtime > 0:
+            self.classifier.observe(controller.request, controller.runtime)
+
+    def enqueue(self, controller):
+        """Put a request into the queue unless we're overloaded"""
+        queries, pool = self.route(controller)
+        if self.admit(controller, queries, pool):
+            if self.slow_queries is not None and controller.pool is None:
+                controller.add_done_callback(self.observe)
+            pool.requests.inc()
+            queries.put(controller)
+
+    def admit(self, controller, queries, pool):
+        """Decide whether a new request is queued. If it isn't, it's
+        answered with ERROR_BUSY right away, so the client can back off.
+        """
+        reason = None
+        if self.max_queue > 0 and queries.qsize() >= self.max_queue:
+            reason = 'queue'
+        elif self.max_wait > 0 and queries.expected_wait(len(pool.workers)) > self.max_wait:
+            reason = 'wait'
+        if reason is None:
+            return True
+        self.rejected[reason].inc()
+        controller.set_error(ERROR_BUSY)
+        controller.set_ready()
+        return False
@@ -0,0 +1,124 @@
+import unittest
+import threading
+import time
+import types
+
+import metrics
+from config_loader import Config
+from dispatcher import Dispatcher
+from maxima_threads import RequestController, RequestQueue
+
+
+def fake_pool(queries, workers=1, idle=0):
+    """Stands in for a MaximaPool, the dispatcher doesn't need workers"""
+    return types.SimpleNamespace(queries=queries, workers=[None] * workers,
+                                 idle_workers=lambda: idle, requests=metrics.Counter())
+
+
+class DispatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config()
+        self.config['Maxima']['timeout'] = '10'
+        self.config['Maxima']['max_timeout'] = '60'
+
+    def dispatcher(self, **options):
+        for key, value in options.items():
+            section = 'Cache' if key == 'size' else 'Server'
+            self.config[section][key] = value
+        dispatcher = Dispatcher(self.config)
+        dispatcher.pool = fake_pool(dispatcher.queries)
+        if dispatcher.slow_queries is not None:
+            dispatcher.slow_pool = fake_pool(dispatcher.slow_queries)
+        return dispatcher
+
+    def dispatch(self, dispatcher, request):
+        controller = RequestController(request)
+        dispatcher.dispatch(controller)
+        return controller
+
+    def testEnqueue(self):
+        dispatcher = self.dispatcher()
+        controller = self.dispatch(dispatcher, '12+12;')
+        self.assertFalse(controller.is_ready())
+        self.assertTrue(dispatcher.queries.qsize() == 1)
+        self.assertTrue(dispatcher.pool.requests.value == 1)
+
+    def testRejectFullQueue(self):
+        dispatcher = self.dispatcher(max_queue='1')
+        rejected = dispatcher.rejected['queue'].value
+        self.dispatch(dispatcher, '12+12;')
+        controller = self.dispatch(dispatcher, '12+13;')
+        self.assertTrue(controller.is_ready())
+        self.assertTrue(controller.get_reply() == ';ERR;BUSY')
+        self.assertTrue(dispatcher.queries.qsize() == 1)
+        self.assertTrue(dispatcher.rejected['queue'].value == rejected + 1)
+
+    def testRejectLongWait(self):
+        dispatcher = self.dispatcher(max_wait='1')
+        rejected = dispatcher.rejected['wait'].value
+        dispatcher.queries.observe_service(2)
+        self.assertFalse(self.dispatch(dispatcher, '12+12;').is_ready())
+        # One worker needs two seconds for the request in the queue
+        controller = self.dispatch(dispatcher, '12+13;')
+        self.assertTrue(controller.get_reply() == ';ERR;BUSY')
+        self.assertTrue(dispatcher.rejected['wait'].value == rejected + 1)
+
+    def testRejectBatch(self):
+        dispatcher = self.dispatcher(max_queue='1')
+        self.dispatch(dispatcher, '12+12;')
+        controller = self.dispatch(dispatcher, ';BATCH;1;\t2;')
+        self.assertTrue(controller.get_reply() == ';ERR;BUSY\n;NEXT;\n;ERR;BUSY')
+
+    def testCache(self):
+        dispatcher = self.dispatcher(size='10')
+        first = self.dispatch(dispatcher, '12+12;')
+        worker = dispatcher.queries.get_request(threading.Event())
+        self.assertTrue(worker is first)
+        worker.set_reply('24')
+        worker.set_ready()
+
+        # The second one is answered from the cache
+        second = self.dispatch(dispatcher, '12+12;')
+        self.assertTrue(second.is_ready())
+        self.assertTrue(second.get_reply() == '24')
+        self.assertTrue(dispatcher.queries.qsize() == 0)
+        self.assertTrue((dispatcher.cache.hits, dispatcher.cache.misses) == (1, 1))
+
+    def testOptions(self):
+        dispatcher = self.dispatcher()
+        controller = self.dispatch(dispatcher, ';OPTIONS timeout=5 deadline=10;12+12;')
+        self.assertTrue(controller.request == '12+12;')
+        self.assertTrue(controller.timeout == 5)
+        self.assertTrue(9 < controller.deadline - time.monotonic() <= 10)
+        # Clients can't go beyond max_timeout
+        controller = self.dispatch(dispatcher, ';OPTIONS timeout=100;12+12;')
+        self.assertTrue(controller.timeout == 60)
+
+    def testInvalidOptions(self):
+        dispatcher = self.dispatcher()
+        for value in ('nan', 'inf', '-inf', '0', '-1', 'x', ''):
+            controller = self.dispatch(dispatcher, ';OPTIONS timeout=%s deadline=%s;12+12;' %
+                                       (value, value))
+            self.assertTrue(controller.timeout is None)
+            self.assertTrue(controller.deadline is None)
+
+    def testRoute(self):
+        self.config['Maxima']['slow_threads'] = '1'
+        dispatcher = self.dispatcher()
+        dispatcher.pools['draw'] = fake_pool(RequestQueue())
+        self.dispatch(dispatcher, '12+12;')
+        self.dispatch(dispatcher, '12^12^12^12;')
+        # A timeout beyond the one of the fast pool
+        self.dispatch(dispatcher, ';OPTIONS timeout=30;12+12;')
+        self.dispatch(dispatcher, ';OPTIONS pool=draw;12+12;')
+        self.dispatch(dispatcher, ';OPTIONS pool=unknown;12+12;')
+        self.assertTrue(dispatcher.queries.qsize() == 2)
+        self.assertTrue(dispatcher.slow_queries.qsize() == 2)
+        self.assertTrue(dispatcher.pools['draw'].queries.qsize() == 1)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
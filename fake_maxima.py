@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# A tiny stand-in for Maxima. It speaks just enough of the Maxima console
+# protocol for the workers: it prints (%iN) input prompts and (%oN) output
+# lines. Simple arithmetic is evaluated, everything else is echoed back.
+# Expressions with an exponent tower like 12^12^12^12 never return, just
+# like they effectively don't in a real Maxima. A SIGINT interrupts them
+# and returns to the input prompt, optionally after a debugger prompt.
+# quit() exits like a Maxima which crashed.
+# Saving a core with :lisp (sb-ext:save-lisp-and-die "path" ...) writes a
+# script which starts a fake Maxima without the boot delay.
+#
+# It's used for tests and benchmarks on hosts without Maxima. Point the
+# path option of the [Maxima] section to this file to use it.
+
+import argparse
+import os
+import re
+import sys
+import time
+
+# Expressions we evaluate with python
+ARITHMETIC_RE = re.compile(r"^[0-9+\-*/^(). ]+$")
+# Expressions we treat as runaway computations
+TOWER_RE = re.compile(r"\^[^^]*\^")
+# Saving a core like an SBCL based Maxima does
+SAVE_CORE_RE = re.compile(r'^:lisp.*save-lisp-and-die\s+"([^"]+)"')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='A fake Maxima for tests and benchmarks.')
+    parser.add_argument('--boot', type=float,
+                        default=float(os.environ.get('FAKE_MAXIMA_BOOT', 0)),
+                        help="seconds to wait before the first prompt, like Lisp booting")
+    parser.add_argument('--preloaded', action='store_true',
+                        help="started from a saved core, don't boot")
+    parser.add_argument('--delay', type=float,
+                        default=float(os.environ.get('FAKE_MAXIMA_DELAY', 0)),
+                        help="seconds to wait before each output")
+    parser.add_argument('--size', type=int,
+                        default=int(os.environ.get('FAKE_MAXIMA_SIZE', 0)),
+                        help="pad every output to at least this many characters")
+    parser.add_argument('--debugger', action='store_true',
+                        default=bool(os.environ.get('FAKE_MAXIMA_DEBUGGER')),
+                        help="enter the debugger after a SIGINT")
+    parser.add_argument('--chunks', type=int,
+                        default=int(os.environ.get('FAKE_MAXIMA_CHUNKS', 1)),
+                        help="number of separate writes used for every reply")
+    # Options we don't understand are Maxima options. Ignore them.
+    args, unknown = parser.parse_known_args()
+    return args
+
+
+class FakeMaxima:
+
+    def __init__(self, args):
+        self.args = args
+        self.counter = 1
+        self.out = sys.stdout.buffer
+
+    def write(self, text):
+        """Write text to stdout in the configured number of chunks"""
+        data = bytes(text, "UTF-8")
+        chunks = max(1, self.args.chunks)
+        step = max(1, -(-len(data) // chunks))
+        for start in range(0, len(data), step):
+            self.out.write(data[start:start + step])
+            self.out.flush()
+            if chunks > 1:
+                time.sleep(.001)
+
+    def prompt(self):
+        return "(%i" + str(self.counter) + ") "
+
+    def evaluate(self, statement):
+        if statement == 'quit()':
+            sys.exit(0)
+        if TOWER_RE.search(statement):
+            # Runaway computation, wait until someone interrupts or kills us.
+            while True:
+                time.sleep(1)
+        if ARITHMETIC_RE.match(statement):
+            try:
+                return str(eval(statement.replace('^', '**'), {'__builtins__': {}}))
+            except (SyntaxError, ArithmeticError):
+                pass
+        return statement
+
+    def run(self):
+        if self.args.boot and not self.args.preloaded:
+            time.sleep(self.args.boot)
+        self.write("Maxima 5.0.0 (fake) http://maxima.sourceforge.net\n")
+        self.write(self.prompt())
+
+        self.pending = ''
+        while True:
+            try:
+                line = sys.stdin.readline()
+                if not line:
+                    break
+                self.process(line)
+            except KeyboardInterrupt:
+                self.interrupted()
+
+    def process(self, line):
+        match = SAVE_CORE_RE.match(line)
+        if match:
+            self.save_core(match.group(1))
+        self.pending += line.strip()
+        reply = ''
+        done = False
+        # Process every complete statement on the line
+        while True:
+            match = re.search(r"[;$]", self.pending)
+            if not match:
+                break
+            statement = self.pending[:match.start()].strip()
+            terminator = match.group(0)
+            self.pending = self.pending[match.end():]
+            done = True
+
+            if self.args.delay:
+                time.sleep(self.args.delay)
+            if statement and terminator == ';':
+                result = self.evaluate(statement)
+                if len(result) < self.args.size:
+                    result += ' ' * (self.args.size - len(result))
+                reply += "(%o" + str(self.counter) + ") " + result + "\n"
+            self.counter += 1
+        if done:
+            self.write(reply + self.prompt())
+
+    def save_core(self, path):
+        """Write a script which starts a preloaded fake Maxima and exit"""
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" --preloaded "$@"\n' %
+                    (sys.executable, os.path.abspath(__file__)))
+        os.chmod(path, 0o755)
+        sys.exit(0)
+
+    def interrupted(self):
+        """SIGINT, stop what we're doing and return to the input prompt"""
+        self.pending = ''
+        if self.args.debugger:
+            # Enter the debugger and wait until we're told to leave it
+            self.write("\nConsole interrupt.\n(dbm:1) ")
+            while sys.stdin.readline().strip() != ':top':
+                self.write("(dbm:1) ")
+        else:
+            self.write("\nMaxima encountered a Lisp error:\n\n Console interrupt.\n\n"
+                       "Automatically continuing.\n")
+        self.counter += 1
+        self.write(self.prompt())
+
+
+if __name__ == "__main__":
+    try:
+        FakeMaxima(parse_args()).run()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
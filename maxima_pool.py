@@ -0,0 +1,216 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import logging
+import threading
+import time
+
+import metrics
+from maxima_process import parse_cpus
+from maxima_threads import MaximaWorker
+
+logger = logging.getLogger("tcp2maxima")
+
+
+class MaximaPool(threading.Thread):
+    """ The Maxima workers processing the queries of a queue. The thread
+    itself supervises the pool: It starts more workers if the queue grows
+    and retires idle workers after a while. The pool never has less than
+    min_workers and never more than max_workers workers.
+
+    Workers boot in their own threads, so they start at the same time and
+    join the pool one by one as soon as their Maxima is ready.
+
+    The metrics of the pool are labelled with its name. The workers of
+    the default pool are numbered, those of other pools are named after
+    the pool. Requests which time out are put into the queue demote_to
+    if it's set.
+    """
+
+    def __init__(self, queries, cfg, standby=None, name='default', demote_to=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queries = queries
+        self.cfg = cfg
+        self.standby = standby
+        self.name = name
+        self.demote_to = demote_to
+        self.workers = []
+        self.count = 0 # Used to name the workers
+        self.failed = 0 # Workers whose Maxima didn't boot
+        self.stop = threading.Event()
+        # Notified whenever a worker is ready to take requests
+        self.ready = threading.Condition()
+
+        # Without min_workers and max_workers the pool has a fixed size
+        self.min_workers = int(cfg.get('min_workers', cfg['threads']))
+        self.max_workers = max(self.min_workers, int(cfg.get('max_workers', self.min_workers)))
+        # Grow if more requests are queued or the oldest one waits longer
+        self.scale_up_depth = int(cfg.get('scale_up_depth', 1))
+        self.scale_up_wait = float(cfg.get('scale_up_wait', 0.5))
+        # Retire workers which were idle for that many seconds
+        self.scale_down_idle = float(cfg.get('scale_down_idle', 60))
+        self.scale_interval = float(cfg.get('scale_interval', 1))
+        # Every worker is pinned to cpus_per_worker of the configured CPUs,
+        # 0 means they all share them
+        self.cpus = parse_cpus(cfg.get('cpus', ''))
+        self.cpus_per_worker = int(cfg.get('cpus_per_worker', 1))
+        # Statistics
+        self.scale_ups = 0
+        self.scale_downs = 0
+        self.register_metrics(metrics.REGISTRY)
+
+    def register_metrics(self, registry):
+        pool = {'pool': self.name}
+        for priority in self.queries.priorities:
+            registry.gauge('tcp2maxima_queue_depth', 'Requests waiting for a worker',
+                           lambda p=priority: self.queries.depth(p), labels=dict(pool, priority=priority))
+        registry.gauge('tcp2maxima_queue_oldest_wait_seconds', 'Time the oldest queued request waits',
+                       self.queries.oldest_wait, labels=pool)
+        registry.gauge('tcp2maxima_workers', 'Maxima workers by state',
+                       lambda: sum(1 for w in self.workers if w.ready.is_set() and w.busy),
+                       labels=dict(pool, state='busy'))
+        registry.gauge('tcp2maxima_workers', 'Maxima workers by state',
+                       self.idle_workers, labels=dict(pool, state='idle'))
+        registry.gauge('tcp2maxima_workers', 'Maxima workers by state',
+                       lambda: len(self.workers) - self.ready_workers(), labels=dict(pool, state='starting'))
+        registry.gauge('tcp2maxima_scale_ups_total', 'Workers started because of the load',
+                       lambda: self.scale_ups, labels=pool, kind='counter')
+        registry.gauge('tcp2maxima_scale_downs_total', 'Idle workers retired',
+                       lambda: self.scale_downs, labels=pool, kind='counter')
+        registry.gauge('tcp2maxima_expected_wait_seconds',
+                       'Estimated time a new request waits in the queue',
+                       lambda: self.queries.expected_wait(len(self.workers)), labels=pool)
+        self.requests = registry.counter('tcp2maxima_pool_requests_total',
+                                         'Requests put into the queue of the pool', labels=pool)
+
+    def idle_workers(self):
+        """Return the number of workers waiting for a request"""
+        return sum(1 for w in self.workers if w.ready.is_set() and not w.busy)
+
+    def ready_workers(self):
+        """Return the number of workers whose Maxima is initialized"""
+        return sum(1 for w in self.workers if w.ready.is_set())
+
+    def wait_ready(self, count=1, timeout=None):
+        """Wait until count workers are ready to take requests, or all of
+        them if there are less. Returns False if that takes longer than
+        timeout seconds or if none of the workers could start Maxima.
+        """
+        with self.ready:
+            self.ready.wait_for(lambda: self.ready_workers() >= min(count, len(self.workers)),
+                                timeout)
+            return len(self.workers) > 0 and self.ready_workers() >= min(count, len(self.workers))
+
+    def _worker_ready(self, worker):
+        with self.ready:
+            self.ready.notify_all()
+        logger.info("Maxima worker %s is ready, %d of %d workers ready." %
+                    (worker.name, self.ready_workers(), len(self.workers)))
+
+    def _worker_failed(self, worker):
+        with self.ready:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.failed += 1
+            self.ready.notify_all()
+        metrics.REGISTRY.remove('tcp2maxima_worker_rss_bytes', labels={'worker': worker.name})
+        logger.error("Maxima worker %s didn't start, %d workers left." %
+                     (worker.name, len(self.workers)))
+
+    def start_workers(self):
+        """Start the minimal number of workers"""
+        logger.info("Starting " + str(self.min_workers) + " Maxima threads in the " +
+                    self.name + " pool.")
+        for i in range(self.min_workers):
+            self.add_worker()
+
+    def worker_cpus(self):
+        """Return the CPUs for a new worker: the configured CPUs the fewest
+        workers run on, or None if the workers share the CPUs.
+        """
+        if not self.cpus or self.cpus_per_worker < 1:
+            return None
+        used = collections.Counter(cpu for w in self.workers for cpu in (w.cpus or []))
+        return sorted(sorted(self.cpus, key=lambda cpu: used[cpu])[:self.cpus_per_worker])
+
+    def add_worker(self):
+        name = self.count if self.name == 'default' else self.name + str(self.count)
+        worker = MaximaWorker(name, self.queries, self.cfg, self.standby, self.worker_cpus(),
+                              self.demote_to)
+        worker.on_ready = self._worker_ready
+        worker.on_failed = self._worker_failed
+        self.count += 1
+        metrics.REGISTRY.gauge('tcp2maxima_worker_rss_bytes', 'Resident memory of the Maxima of a worker',
+                               lambda: worker.rss, labels={'worker': worker.name})
+        worker.setDaemon(True)
+        # The worker may fail before start() returns
+        self.workers.append(worker)
+        worker.start()
+        return worker
+
+    def retire_worker(self, worker):
+        self.workers.remove(worker)
+        metrics.REGISTRY.remove('tcp2maxima_worker_rss_bytes', labels={'worker': worker.name})
+        worker.quit_worker()
+        worker.join()
+
+    def run(self):
+        """ Supervises the pool until quit() is called """
+        if self.max_workers == self.min_workers:
+            return
+        while not self.stop.wait(self.scale_interval):
+            self.scale()
+
+    def scale(self):
+        """Start or retire a worker if necessary"""
+        depth = self.queries.qsize()
+        wait = self.queries.oldest_wait()
+        # Workers which are still booting take the queued requests soon
+        starting = len(self.workers) - self.ready_workers()
+        if len(self.workers) < self.max_workers and starting < depth and \
+                (depth > self.scale_up_depth or wait > self.scale_up_wait):
+            worker = self.add_worker()
+            self.scale_ups += 1
+            logger.info("Queue depth %d, oldest request waits %.2f s: started worker %s, %d workers." %
+                        (depth, wait, worker.name, len(self.workers)))
+            return
+
+        if len(self.workers) > self.min_workers and depth == 0:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.ready.is_set() and not worker.busy and \
+                        now - worker.idle_since > self.scale_down_idle:
+                    self.retire_worker(worker)
+                    self.scale_downs += 1
+                    logger.info("Worker %s was idle for %.0f s: retired, %d workers." %
+                                (worker.name, now - worker.idle_since, len(self.workers)))
+                    return
+
+    def quit(self):
+        """Quit the supervisor and all workers"""
+        self.stop.set()
+        if self.is_alive():
+            self.join()
+        logger.debug("Quitting the Maxima workers.")
+        for worker in self.workers:
+            worker.quit_worker()
+        for worker in self.workers:
+            worker.join()
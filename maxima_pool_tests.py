@@ -0,0 +1,117 @@
+import unittest
+import os
+import time
+import types
+
+import metrics
+from maxima_pool import MaximaPool
+from maxima_threads import RequestController
+from maxima_threads import RequestQueue
+from testing import maxima_config, start_pool
+
+
+class MaximaPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = maxima_config()
+        self.config.update({'min_workers': '1', 'max_workers': '3', 'scale_interval': '0.1',
+                            'scale_up_wait': '0.1', 'scale_down_idle': '0.5', 'interrupt': '2'})
+        self.queries = RequestQueue()
+        self.pool = start_pool(self, self.config, self.queries)
+        self.pool.start()
+
+    def testScaleUpAndDown(self):
+        self.assertTrue(len(self.pool.workers) == 1)
+        controllers = [RequestController('12^12^12^12;') for i in range(6)]
+        for controller in controllers:
+            self.queries.put(controller)
+        for controller in controllers:
+            controller.wait()
+        self.assertTrue(self.pool.scale_ups == 2)
+        self.assertTrue(len(self.pool.workers) == 3)
+
+        # Idle workers are retired again
+        for i in range(100):
+            if len(self.pool.workers) == 1:
+                break
+            time.sleep(.1)
+        self.assertTrue(len(self.pool.workers) == 1)
+        self.assertTrue(self.pool.scale_downs == 2)
+
+    def testScaleUpWhileBooting(self):
+        pool = start_pool(self, dict(self.config, max_workers='8'))
+        self.assertTrue(pool.wait_ready(1, 5))
+        os.environ['FAKE_MAXIMA_BOOT'] = '3'
+        try:
+            pool.start()
+            for i in range(3):
+                pool.queries.put(RequestController('12^12^12^12;'))
+            time.sleep(1.5)
+        finally:
+            del os.environ['FAKE_MAXIMA_BOOT']
+        # The booting workers will take the queued requests
+        self.assertTrue(len(pool.workers) <= 3)
+
+    def testParallelStartup(self):
+        os.environ['FAKE_MAXIMA_BOOT'] = '0.5'
+        try:
+            start = time.monotonic()
+            pool = start_pool(self, dict(self.config, min_workers='4', max_workers='4'))
+            self.assertTrue(pool.wait_ready(1, 5))
+            self.assertTrue(pool.wait_ready(4, 5))
+        finally:
+            del os.environ['FAKE_MAXIMA_BOOT']
+        # The workers booted at the same time, not one after another
+        self.assertTrue(time.monotonic() - start < 1.5)
+        self.assertTrue(pool.idle_workers() == 4)
+
+    def testNamedPool(self):
+        pool = start_pool(self, dict(self.config, min_workers='1', max_workers='1'), name='draw')
+        self.assertTrue(pool.wait_ready(1, 5))
+        # Workers and metrics of the pool carry its name
+        self.assertTrue(pool.workers[0].name == 'draw0')
+        pool.requests.inc()
+        text = metrics.REGISTRY.render()
+        self.assertTrue('tcp2maxima_pool_requests_total{pool="draw"} 1' in text)
+        self.assertTrue('tcp2maxima_workers{pool="draw",state="idle"} 1' in text)
+        self.assertTrue('tcp2maxima_worker_rss_bytes{worker="draw0"}' in text)
+
+    def testMaximaDoesntStart(self):
+        pool = start_pool(self, dict(self.config, path='false', min_workers='2', max_workers='2'))
+        # We don't wait for workers which can't become ready
+        start = time.monotonic()
+        self.assertFalse(pool.wait_ready(1, 10))
+        self.assertTrue(time.monotonic() - start < 5)
+        self.assertTrue(pool.workers == [])
+        self.assertTrue(pool.failed == 2)
+
+    def testQuitWhileBooting(self):
+        os.environ['FAKE_MAXIMA_BOOT'] = '30'
+        try:
+            pool = start_pool(self, dict(self.config, timeout='60', min_workers='2', max_workers='2'))
+            time.sleep(.2)
+        finally:
+            del os.environ['FAKE_MAXIMA_BOOT']
+        # We don't wait for the boot to finish
+        start = time.monotonic()
+        pool.quit()
+        self.assertTrue(time.monotonic() - start < 5)
+        self.assertFalse(any(worker.is_alive() for worker in pool.workers))
+
+    def testWorkerCpus(self):
+        config = dict(self.config)
+        config.update({'cpus': '0-2,5', 'cpus_per_worker': '2'})
+        pool = MaximaPool(RequestQueue(), config)
+        # Every new worker gets the CPUs the fewest workers run on
+        for expected in ([0, 1], [2, 5], [0, 1]):
+            cpus = pool.worker_cpus()
+            self.assertTrue(cpus == expected)
+            pool.workers.append(types.SimpleNamespace(cpus=cpus))
+        config['cpus_per_worker'] = '0'
+        self.assertTrue(MaximaPool(RequestQueue(), config).worker_cpus() is None)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,502 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Python library imports
+import fcntl
+import hashlib
+import logging
+import os
+import queue
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import subprocess as sp
+import threading
+import time
+
+# Local imports
+import replyparser as rp
+
+logger = logging.getLogger("tcp2maxima")
+
+# Size of the buffer we read the Maxima output into
+READ_BUFFER_SIZE = 65536
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Maxima is back at the input prompt after an interrupt
+INPUT_PROMPT_RE = re.compile(r"\(%i\d+\) $")
+# Maxima entered its debugger after an interrupt
+DEBUGGER_PROMPT_RE = re.compile(r"\(dbm:\d+\) $")
+
+# Saved cores which didn't start, we use the plain Maxima instead
+BROKEN_CORES = set()
+
+
+def parse_cpus(spec):
+    """Return the list of CPUs in a spec like 2-5,7. An empty spec
+    means no CPUs were configured.
+    """
+    cpus = []
+    for part in spec.replace(',', ' ').split():
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class MaximaProcess:
+    """ A Maxima process and the pipes we use to talk to it. """
+
+    def __init__(self, name, cfg, cpus=None):
+        self.name = name
+        self.cfg = cfg
+        # The CPUs Maxima may run on, all configured ones by default
+        self.cpus = cpus if cpus is not None else parse_cpus(cfg.get('cpus', ''))
+        # Command line options of Maxima
+        self.options = shlex.split(cfg.get('options', ''))
+        self.parser = rp.ReplyParser(name, int(cfg.get('max_reply_size', 0)))
+        self.buffer = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # Time spent in the parser during the last get_reply()
+        self.parse_time = 0.0
+        self.queries = 0 # Number of queries the process answered
+        self._spawn()
+
+    def _spawn(self):
+        # We wait for Maxima output with a selector and read it
+        # into a buffer which is reused for every read.
+        self.selector = selectors.DefaultSelector()
+        # abort() sets the flag and wakes up the selector with the pipe
+        self.aborted = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+        # Start maxima and set up the process
+        self.died = False # Set as soon as we notice the process is gone
+        self.core = usable_core(self.cfg)
+        self.process = sp.Popen(self.command(), stdin=sp.PIPE, stdout=sp.PIPE, bufsize=0, close_fds=True)
+        self._schedule()
+        # Setting the stdout pipe to non-blocking mode
+        fcntl.fcntl(self.process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        # A pidfd is readable as soon as the process exits, even if
+        # something else still holds its stdout open.
+        self.pidfd = None
+        try:
+            self.pidfd = os.pidfd_open(self.process.pid)
+            self.selector.register(self.pidfd, selectors.EVENT_READ)
+        except (AttributeError, OSError):
+            pass
+
+    def command(self):
+        """Return the list we use to start a maxima process. We start the
+        saved core if there is one, and change the nice value if needed.
+        """
+        command = [self.core or self.cfg['path']] + self.options
+        try:
+            return ['nice', '-n %s' % self.cfg['nice']] + command
+        except KeyError:
+            return command
+
+    def _schedule(self):
+        """Pin the process to its CPUs and set its scheduling policy"""
+        try:
+            if self.cpus:
+                os.sched_setaffinity(self.process.pid, self.cpus)
+            policy = self.cfg.get('scheduler', '')
+            if policy:
+                os.sched_setscheduler(self.process.pid, getattr(os, 'SCHED_' + policy.upper()),
+                                      os.sched_param(0))
+        except (AttributeError, OSError) as e:
+            logger.warning("Maxima %s: can't set the CPUs or the scheduler: %s" % (self.name, e))
+
+    def pin(self, cpus):
+        """Move the process to other CPUs, used when a worker adopts a
+        standby process.
+        """
+        self.cpus = cpus
+        self._schedule()
+
+    def set_name(self, name):
+        """Rename the process, used when a worker adopts a standby process"""
+        self.name = name
+        self.parser.thread = name
+
+    def start(self):
+        """Wait for the first prompt and initialize Maxima. Doesn't raise
+        if Maxima dies while it boots, check is_alive() afterwards. Gives
+        up as soon as abort() is called.
+        """
+        # Read until ready
+        try:
+            self.get_reply(abortable=True)
+        except CancelledException:
+            return
+        except TimeoutException:
+            if self.core:
+                logger.error("Maxima %s didn't start from the core %s, using %s instead." %
+                             (self.name, self.core, self.cfg['path']))
+                BROKEN_CORES.add(self.core)
+                self.kill()
+                self._spawn()
+                return self.start()
+            logger.error("Maxima %s didn't start correctly!" % self.name)
+            if not self.is_alive():
+                return
+
+        if self.core:
+            # The core was saved after the initialization
+            return
+
+        # Sends the init string to maxima and reads until ready
+        logger.debug("Maxima " + str(self.name) + " init: " + self.cfg['init'])
+        try:
+            self.send(self.cfg['init'])
+            self.get_reply(abortable=True)
+        except CancelledException:
+            return
+        except TimeoutException:
+            logger.error("Maxima %s didn't initialize correctly!" % self.name)
+
+    def is_alive(self):
+        return not self.died and self.process.poll() is None
+
+    def rss(self):
+        """Return the resident memory of the process in bytes, 0 if we
+        can't tell.
+        """
+        try:
+            with open('/proc/%d/statm' % self.process.pid) as f:
+                return int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            return 0
+
+    def send(self, line):
+        """Send a line to maxima, making sure there is a line end char at the end"""
+
+        # Remove whitespaces at the end and append a line end character
+        line = line.rstrip()
+        line += "\n"
+
+        # Send to stdin of Maxima and flush the cache
+        try:
+            self.process.stdin.write(bytes(line, "UTF-8"))
+            self.process.stdin.flush()
+        except OSError:
+            logger.error("Maxima %s doesn't accept input anymore.", self.name)
+            self.died = True
+            raise ProcessDiedException
+
+    def drain(self):
+        """Throw away everything which is left in the stdout pipe"""
+        try:
+            while self.process.stdout.readinto(self.buffer):
+                pass
+        except OSError:
+            pass
+
+    def _fill(self, deadline, abortable=False):
+        """Wait until Maxima writes something and read it into our buffer.
+        Returns the number of bytes read or None if there is no output
+        before the deadline. If abortable is set, raises a
+        CancelledException as soon as abort() is called.
+        """
+        while True:
+            if abortable and self.aborted:
+                raise CancelledException
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            events = self.selector.select(remaining)
+            if not events:
+                return None
+            if any(key.fileobj == self.wakeup_r for key, mask in events):
+                try:
+                    os.read(self.wakeup_r, 64)
+                except BlockingIOError:
+                    pass
+                continue
+            exited = any(key.fileobj == self.pidfd for key, mask in events)
+
+            size = self.process.stdout.readinto(self.buffer)
+            if size is None:
+                if exited:
+                    # Everything it wrote is read, it won't write more
+                    logger.error("Maxima %s exited with %s.", self.name, self.process.poll())
+                    self.died = True
+                    raise ProcessDiedException
+                # Nothing to read after all
+                continue
+            if size == 0:
+                # Maxima closed its output, it won't ever return to a prompt.
+                logger.error("Maxima %s closed its output.", self.name)
+                self.died = True
+                raise ProcessDiedException
+            return size
+
+    def read(self, deadline):
+        """Wait until Maxima writes something and return it. Returns None
+        if there is no output before the deadline.
+        """
+        size = self._fill(deadline)
+        if size is None:
+            return None
+        return str(self.view[:size], "UTF-8", "replace")
+
+    def get_reply(self, on_line=None, timeout=None, abortable=False):
+        """Read the output of Maxima until it returns to an input prompt.
+
+        We sleep in the selector until Maxima writes something, so the
+        reply is processed as soon as it arrives. Every complete output
+        line is passed to on_line right away if it's given. Raises a
+        TimeoutException if Maxima doesn't return to a input prompt within
+        timeout seconds, by default the configured timeout. If abortable
+        is set, raises a CancelledException as soon as abort() is called.
+        """
+        # This method blocks if maxima doesn't return to a input
+        # prompt. This is intended that we get a timeout if Maxima
+        # doesn't like our query
+        if timeout is None:
+            timeout = float(self.cfg['timeout'])
+        deadline = time.monotonic() + timeout
+        ready = False
+        self.parse_time = 0.0
+        self.parser.reset()
+
+        logger.debug("Worker %s waits for Maxima reply.", self.name)
+        while not ready:
+            try:
+                size = self._fill(deadline, abortable)
+            except CancelledException:
+                self.drain()
+                raise
+            if size is None:
+                # Make sure the buffer is empty before we do anything
+                # like killing a thread
+                self.drain()
+                raise TimeoutException
+
+            start = time.monotonic()
+            lines, ready = self.parser.feed(self.view[:size])
+            self.parse_time += time.monotonic() - start
+            if on_line:
+                for line in lines:
+                    on_line(line)
+
+        logger.debug("Maxima %s sent full reply.", self.name)
+        # Just in case something is stuck in the buffer, we make sure it's empty
+        self.drain()
+        return self.parser.reply()
+
+    def abort(self):
+        """Make get_reply() give up waiting, called from other threads"""
+        self.aborted = True
+        if self.wakeup_w is None:
+            return
+        try:
+            os.write(self.wakeup_w, b'x')
+        except OSError:
+            pass
+
+    def clear_abort(self):
+        self.aborted = False
+
+    def interrupt(self, grace):
+        """Interrupt the running computation with SIGINT. Returns True if
+        Maxima is back at its input prompt within grace seconds.
+        """
+        if grace <= 0 or not self.is_alive():
+            return False
+        logger.debug("Interrupting Maxima %s.", self.name)
+        self.process.send_signal(signal.SIGINT)
+
+        deadline = time.monotonic() + grace
+        output = ''
+        try:
+            while True:
+                chunk = self.read(deadline)
+                if chunk is None:
+                    return False
+                logger.debug("Worker %s received: %s", self.name, chunk)
+                output += chunk
+                if INPUT_PROMPT_RE.search(output):
+                    self.drain()
+                    return True
+                if DEBUGGER_PROMPT_RE.search(output):
+                    # Leave the debugger and return to the top level
+                    self.send(':top')
+                    output = ''
+        except (TimeoutException, OSError):
+            return False
+
+    def kill(self):
+        """Kill the process, used if it doesn't respond anymore"""
+        self._close()
+        self.process.kill()
+        self.process.wait() # Wait for the return code
+
+    def terminate(self):
+        """Ask the process to exit and wait for it"""
+        self._close()
+        self.process.terminate()
+        self.process.wait()
+
+    def _close(self):
+        self.selector.close()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+        wakeup_w, self.wakeup_w = self.wakeup_w, None
+        os.close(self.wakeup_r)
+        os.close(wakeup_w)
+
+
+def usable_core(cfg):
+    """Return the path of the saved core if we can use it, otherwise None"""
+    core = cfg.get('core', '')
+    if core and core not in BROKEN_CORES and os.access(core, os.X_OK):
+        return core
+    return None
+
+
+def _core_stamp(cfg):
+    """Return a string which changes if the core has to be rebuilt"""
+    stamp = hashlib.sha1()
+    for key in ('path', 'options', 'init', 'preload', 'save_core'):
+        stamp.update(bytes(key + '=' + cfg.get(key, '') + '\n', 'UTF-8'))
+    binary = shutil.which(cfg['path'])
+    if binary:
+        stamp.update(bytes(str(os.stat(binary).st_mtime), 'UTF-8'))
+    return stamp.hexdigest()
+
+
+def build_core(cfg):
+    """Save a Maxima core which is initialized and has the preload packages
+    loaded, unless there is one which is up to date. Processes started from
+    the core skip most of the boot time. Returns True if the core is usable.
+    """
+    core = cfg.get('core', '')
+    if not core:
+        return False
+    stamp = _core_stamp(cfg)
+    try:
+        with open(core + '.stamp') as f:
+            if f.read() == stamp and os.path.exists(core):
+                return True
+    except OSError:
+        pass
+
+    logger.info("Building the Maxima core " + core)
+    start = time.monotonic()
+    plain = dict(cfg)
+    plain['core'] = '' # Start the plain Maxima
+    process = MaximaProcess('core', plain)
+    try:
+        process.start()
+        for package in cfg.get('preload', '').split():
+            process.send('load("%s")$' % package)
+            process.get_reply()
+        process.send(cfg['save_core'].replace('{core}', core))
+        process.process.wait(float(cfg['timeout']))
+    except (TimeoutException, sp.TimeoutExpired):
+        logger.error("Maxima didn't save the core " + core)
+        process.kill()
+        return False
+    process.terminate()
+    if not os.path.exists(core):
+        logger.error("Maxima didn't save the core " + core)
+        return False
+
+    with open(core + '.stamp', 'w') as f:
+        f.write(stamp)
+    BROKEN_CORES.discard(core)
+    logger.info("Built the Maxima core in %.1f s." % (time.monotonic() - start))
+    return True
+
+
+class StandbyPool(threading.Thread):
+    """ A few Maxima processes which are started and initialized in the
+    background. A worker whose Maxima timed out takes one of them instead
+    of waiting for a new Maxima to start.
+    """
+
+    def __init__(self, cfg, size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cfg = cfg
+        self.size = size
+        self.count = 0 # Used to name the processes
+        self.processes = queue.Queue()
+        self.taken = threading.Event() # Set if we have to start new processes
+        self.taken.set()
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            self.taken.wait()
+            self.taken.clear()
+            while self.processes.qsize() < self.size and not self.stop.is_set():
+                self.count += 1
+                process = MaximaProcess('standby' + str(self.count), self.cfg)
+                process.start()
+                self.processes.put(process)
+                logger.debug("Maxima %s is ready." % process.name)
+
+        # Quit the processes nobody needed
+        self._terminate_all()
+
+    def take(self):
+        """Return a initialized Maxima process or None if there is none"""
+        while True:
+            try:
+                process = self.processes.get(block=False)
+            except queue.Empty:
+                return None
+            # Start a replacement in the background
+            self.taken.set()
+            if process.is_alive():
+                return process
+            process.kill()
+
+    def quit(self):
+        self.stop.set()
+        self.taken.set()
+        self._terminate_all()
+
+    def _terminate_all(self):
+        while True:
+            try:
+                self.processes.get(block=False).terminate()
+            except queue.Empty:
+                return
+
+
+class TimeoutException(Exception):
+    pass
+
+
+class CancelledException(Exception):
+    pass
+
+
+class ProcessDiedException(TimeoutException):
+    """ Maxima exited, e.g. because it ran out of heap """
+    pass
@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+import maxima_process
+from maxima_process import MaximaProcess, build_core, parse_cpus
+from testing import maxima_config
+
+
+class MaximaProcessTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = maxima_config()
+        self.dir = tempfile.mkdtemp()
+        self.config['core'] = os.path.join(self.dir, 'maxima.core')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        maxima_process.BROKEN_CORES.clear()
+
+    def testCommand(self):
+        self.config.update({'options': '--very-quiet --lisp=sbcl', 'nice': '19'})
+        process = MaximaProcess('test', self.config)
+        self.assertTrue(process.command() == ['nice', '-n 19', self.config['path'],
+                                              '--very-quiet', '--lisp=sbcl'])
+        process.kill()
+
+    def testRss(self):
+        process = MaximaProcess('test', self.config)
+        process.start()
+        self.assertTrue(process.rss() > 0)
+        process.terminate()
+        self.assertTrue(process.rss() == 0)
+
+    def testCpusAndScheduler(self):
+        self.assertTrue(parse_cpus('') == [])
+        self.assertTrue(parse_cpus('0-2, 5') == [0, 1, 2, 5])
+        self.config.update({'cpus': '0', 'scheduler': 'batch'})
+        process = MaximaProcess('test', self.config)
+        self.assertTrue(os.sched_getaffinity(process.process.pid) == {0})
+        self.assertTrue(os.sched_getscheduler(process.process.pid) == os.SCHED_BATCH)
+        process.kill()
+
+    def testBuildCore(self):
+        self.config['timeout'] = '2.5'
+        self.assertTrue(build_core(self.config))
+        self.assertTrue(os.path.exists(self.config['core']))
+        built = os.stat(self.config['core']).st_mtime
+
+        process = MaximaProcess('test', self.config)
+        self.assertTrue(process.core == self.config['core'])
+        process.start()
+        process.send('12+12;')
+        self.assertTrue(process.get_reply() == '24')
+        process.terminate()
+
+        # The core is up to date
+        time.sleep(.1)
+        self.assertTrue(build_core(self.config))
+        self.assertTrue(os.stat(self.config['core']).st_mtime == built)
+
+    def testBrokenCore(self):
+        with open(self.config['core'], 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        os.chmod(self.config['core'], 0o755)
+
+        # We fall back to the plain Maxima
+        process = MaximaProcess('test', self.config)
+        process.start()
+        self.assertTrue(process.core is None)
+        process.send('12+12;')
+        self.assertTrue(process.get_reply() == '24')
+        process.terminate()
+
+    def testDiesWhileBooting(self):
+        # Exits right after the first prompt and doesn't take the init
+        path = os.path.join(self.dir, 'maxima')
+        with open(path, 'w') as f:
+            f.write("#!/bin/sh\nexec 0<&-\nprintf '(%%i1) '\nexit 1\n")
+        os.chmod(path, 0o755)
+        self.config.update({'path': path, 'core': ''})
+
+        process = MaximaProcess('test', self.config)
+        process.start()
+        self.assertFalse(process.is_alive())
+        process.kill()
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
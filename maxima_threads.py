@@ -18,16 +18,19 @@
 #
 
 # Python library imports
-import fcntl
+import heapq
+import itertools
 import logging
-import os
+import math
 import queue
-import subprocess as sp
 import threading
+
 import time
 
 # Local imports
-import replyparser as rp
+import batch
+import metrics
+from maxima_process import MaximaProcess, TimeoutException, CancelledException, ProcessDiedException
 from requestfilter import RequestFilter
 
 # Get a logger
@@ -37,13 +40,67 @@ logger = logging.getLogger("tcp2maxima")
 
 ERROR_TIMEOUT = ";ERR;TIMEOUT"
 ERROR_OUTPUT =  ";ERR;NO_OUTPUT"
+ERROR_TOO_LARGE = ";ERR;TOO_LARGE"
+ERROR_EXPIRED = ";ERR;EXPIRED"
+ERROR_CANCELLED = ";ERR;CANCELLED"
+ERROR_BUSY = ";ERR;BUSY"
+ERROR_CRASHED = ";ERR;CRASHED"
+
+# Returned by evaluate() if Maxima died before it sent any output, so
+# the request can be sent to another Maxima.
+RETRY = object()
+# How many times a request is requeued after its Maxima died
+MAX_RETRIES = 1
+
+# Priority classes of requests, most urgent first
+DEFAULT_PRIORITIES = ('interactive', 'default', 'bulk')
+
+# Weight of the latest request in the average service time
+SERVICE_TIME_WEIGHT = 0.1
+
+# Where the time of a request goes
+QUEUE_WAIT = metrics.REGISTRY.histogram('tcp2maxima_queue_wait_seconds',
+                                        'Time a request waits in the queue for a worker')
+SEND_TIME = metrics.REGISTRY.histogram('tcp2maxima_send_seconds',
+                                       'Time to send a request to Maxima')
+COMPUTE_TIME = metrics.REGISTRY.histogram('tcp2maxima_compute_seconds',
+                                          'Time until Maxima returns to the input prompt, without parsing')
+PARSE_TIME = metrics.REGISTRY.histogram('tcp2maxima_parse_seconds',
+                                        'Time spent parsing the Maxima output')
+RESET_TIME = metrics.REGISTRY.histogram('tcp2maxima_reset_seconds',
+                                        'Time to reset Maxima after a request')
+RESET_SKIPS = metrics.REGISTRY.counter('tcp2maxima_reset_skips_total',
+                                       'Requests after which the reset policy skipped the reset')
+TIMEOUTS = metrics.REGISTRY.counter('tcp2maxima_timeouts_total',
+                                    'Requests which timed out')
+INTERRUPTS = metrics.REGISTRY.counter('tcp2maxima_interrupts_total',
+                                      'Maxima processes interrupted after a timeout')
+EXPIRED = metrics.REGISTRY.counter('tcp2maxima_expired_total',
+                                   'Requests dropped because their deadline passed in the queue')
+CANCELLED = metrics.REGISTRY.counter('tcp2maxima_cancelled_total',
+                                     'Requests cancelled because the client disconnected')
+CRASHES = metrics.REGISTRY.counter('tcp2maxima_crashes_total',
+                                   'Maxima processes which died')
+RETRIES = metrics.REGISTRY.counter('tcp2maxima_retries_total',
+                                   'Requests requeued because their Maxima died')
+RESTARTS = metrics.REGISTRY.counter('tcp2maxima_restarts_total',
+                                    'Maxima processes killed and replaced')
+RECYCLES = dict((reason, metrics.REGISTRY.counter('tcp2maxima_recycles_total',
+                                                  'Maxima processes replaced because of their age',
+                                                  labels={'reason': reason}))
+                for reason in ('rss', 'queries'))
+DEMOTIONS = metrics.REGISTRY.counter('tcp2maxima_demotions_total',
+                                     'Requests moved to the slow pool after a timeout')
 
 class MaximaWorker(threading.Thread):
     """ A thread that controls a maxima instance and sends queries to it. """
 
-    def __init__(self, name, queries, cfg):
+    def __init__(self, name, queries, cfg, standby=None, cpus=None, demote_to=None):
         """Initializer. The supervisor sv owns the queue we use for queries.
-        that's why we need it, too.
+        that's why we need it, too. If standby is a StandbyPool, we take
+        our new Maxima from there after a timeout. Our Maxima runs on the
+        given list of CPUs, or on the CPUs configured with cpus. Requests
+        which time out are put into the queue demote_to if it's set.
         """
         logger.debug("Starting Maxima " + str(name) + ".")
         threading.Thread.__init__(self);
@@ -51,201 +108,498 @@ class MaximaWorker(threading.Thread):
         # Initialize instance
         self.cfg = cfg
         self.queries = queries
-        self.parser = rp.ReplyParser(name) # I'm not sure but I think it's not thread safe to have only one global parser...
         self.name = name # Name of the thread, usually a integer
-        self.options = [] 
+        self.standby = standby
+        self.cpus = cpus
+        self.demote_to = demote_to
         self.stop = threading.Event() # A event we use to stop our maxima worker
         self.fltr = RequestFilter()
-
-        # Set up the list we use to start a maxima process. This depends on whether we
-        # have to change the nice value of the maxima processes
-        try:
-            command = ['nice', '-n %s' % self.cfg['nice'], self.cfg['path']] + self.options 
-        except KeyError:
-            command = [self.cfg['path']] + self.options 
-
-        # Start maxima and set up the process
-        self.process = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, bufsize=0, close_fds=True)
-        # Setting the stdout pipe to non-blocking mode
-        # TBH I have no idea how this works, but it does what I want.
-        fcntl.fcntl(self.process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-
-        # Read until ready
-        try:
-            self._get_maxima_reply()
-        except TimeoutException:
-            logger.error("Maxima %s didn't start correctly!" % self.name)
-
-        # Initializing maxima
-        self._init_maxima()
+        self.busy = False # Set while we process a query
+        self.idle_since = time.monotonic()
+        self.current = None # The request we process at the moment
+        self.lock = threading.Lock()
+
+        # When do we reset Maxima: always, on-mutation or every reset_every queries
+        self.reset_policy = self.cfg.get('reset_policy', 'always')
+        self.reset_every = int(self.cfg.get('reset_every', 1))
+        self.clean = True # Maxima is in the state after a reset
+        self.mutated = False # A query since the last reset might have changed something
+        self.unreset = 0 # Number of queries since the last reset
+        # Statistics
+        self.resets = 0
+        self.reset_skips = 0
+        self.reset_time = 0.0
+
+        # Maxima is replaced if its resident memory grows beyond max_rss
+        # megabytes or after max_queries queries. 0 means never.
+        self.max_rss = float(self.cfg.get('max_rss', 0)) * 1024 * 1024
+        self.max_queries = int(self.cfg.get('max_queries', 0))
+        self.rss = 0 # Resident memory of Maxima after the last query
+        self.replacement = None # The new Maxima while it boots
+        self.replacement_thread = None
+
+        # Start maxima. We wait for it to boot in run(), so many
+        # workers can boot at the same time.
+        self.maxima = MaximaProcess(self.name, self.cfg, self.cpus)
+        self.ready = threading.Event() # Set as soon as Maxima is initialized
+        self.on_ready = None # Called with the worker when it's ready
+        self.on_failed = None # Called with the worker if its Maxima didn't boot
 
     def run(self):
         """ Starts the loop which pops elements off the queue. 
         Runs until the stop event is sent from kill_worker().
         """
+        start = time.monotonic()
+        self.maxima.start()
+        if self.stop.is_set():
+            # We were asked to quit while Maxima booted
+            self.maxima.kill()
+            logger.info("Worker " + str(self.name) + " exits")
+            return
+        if not self.maxima.is_alive():
+            # Most likely the path or the options are wrong, a new
+            # Maxima wouldn't do better
+            logger.error("Maxima %s died while booting, the worker exits." % self.name)
+            self.maxima.kill()
+            if self.on_failed:
+                self.on_failed(self)
+            return
+        logger.debug("Maxima %s booted in %.2f s." % (self.name, time.monotonic() - start))
+        self.idle_since = time.monotonic()
+        self.ready.set()
+        if self.on_ready:
+            self.on_ready(self)
+
         logger.info("Maxima" + str(self.name) + " starts processing queries")
         while not self.stop.isSet():
-            # Reset maxima for the next query
-            self._reset_maxima()
-
-            # Don't block while reading the queue because we want to be able to exit
-            query = None
-            while not query:
-                try:
-                    query = self.queries.get(block=False) # Pop a element from the queue.
-                except queue.Empty:
-                    pass
-                time.sleep(.1)
-                if self.stop.isSet():
-                    break
-            
-            if self.stop.isSet():
+            # Replace a Maxima which died, or reset it for the next query
+            self._swap_if_ready()
+            if not self.maxima.is_alive():
+                self._restart_maxima("died")
+            self._reset_if_needed()
+            self._recycle_if_needed()
+
+            # Block until the queue hands us a query or we're asked to quit
+            query = self.queries.get_request(self.stop)
+            if query is None:
                 break
+            # A new Maxima may have booted while we waited
+            self._swap_if_ready()
+            self.busy = True
+            start = time.monotonic()
+            if query.queued_at is not None:
+                QUEUE_WAIT.observe(start - query.queued_at)
 
             response = query # The RequestController to send back the response
-            request = response.request # The sting we want to send to maxima
-
-            
-            # Filter request with our request filter
-            # TODO: What to do if the string isn't accepted?
-            request = self.fltr.filter(request)
-            
-            # Start processing stuff with maxima
-            logger.debug("Maxima " + self.name + " query: " + request)
-            self._send_to_maxima(request)
-
-            # Wait for a reply from maxima
-            try:
-                reply = self._get_maxima_reply()
-                if reply:
-                    response.set_reply(reply)
+            with self.lock:
+                self.current = response
+            if not response.set_on_cancel(lambda: self.abort(response)):
+                # The client went away before we got the request
+                CANCELLED.inc()
+                response.set_error(ERROR_CANCELLED)
+            elif response.items is None:
+                response.set_reply(self.evaluate(response.request, response.stream, response.timeout))
+            else:
+                response.set_reply(self.evaluate_batch(response.items, response.timeout))
+            with self.lock:
+                self.current = None
+                self.maxima.clear_abort()
+
+            response.runtime += time.monotonic() - start
+
+            if response.get_reply() is RETRY:
+                if response.retries < MAX_RETRIES:
+                    # Let another worker try while we replace our Maxima
+                    logger.info("Maxima %s died, requeueing its request." % self.name)
+                    response.retries += 1
+                    RETRIES.inc()
+                    self.queries.put(response)
                 else:
-                    response.set_reply(ERROR_OUTPUT)
-            except TimeoutException:
-                response.set_reply(ERROR_TIMEOUT)
-                self._restart_maxima()
-
-            response.set_ready()
+                    response.set_error(ERROR_CRASHED)
+            if self._should_demote(response):
+                logger.info("Maxima %s timed out, moving the request to the slow pool." % self.name)
+                response.demoted = True
+                DEMOTIONS.inc()
+                self.demote_to.put(response)
+            elif response.get_reply() is not RETRY:
+                response.set_ready()
             # Tell the queue we're done. 
             self.queries.task_done()
+            self.busy = False
+            self.idle_since = time.monotonic()
+            self.queries.observe_service(self.idle_since - start)
                 
 
+        if self.resets:
+            logger.info("Worker %s: %d resets, %.1f ms per reset, %d resets skipped" %
+                        (self.name, self.resets, self.reset_time / self.resets * 1000, self.reset_skips))
+
         # Quit Maxima
-        # self.process.terminate()
-        # time.sleep(1)
-        self.process.terminate()
-        self.process.wait()
+        if self.replacement_thread:
+            self.replacement_thread.join()
+            self.replacement.terminate()
+        self.maxima.terminate()
         # we need to actively delete the process object to really kill the process
-        del self.process 
+        del self.maxima
         logger.info("Worker " + str(self.name) + " exits")
 
+    def _should_demote(self, response):
+        # Only requests which didn't ask for a timeout of their own, and
+        # whose client didn't get part of the output yet, get a second try
+        return self.demote_to is not None and not response.demoted \
+            and response.get_reply() == ERROR_TIMEOUT \
+            and response.timeout is None and response.stream is None
+
     def quit_worker(self):
         """ Sets the event to stop the thread """
         logger.debug("Worker " + str(self.name) + " is about to exit.")
         self.stop.set()
+        # Don't wait for a Maxima which is still booting
+        if not self.ready.is_set():
+            self.maxima.abort()
+        # Wake up the worker if it's waiting for a query
+        self.queries.wake_all()
+
+    def _recover_maxima(self):
+        # Try to interrupt the computation. Only if Maxima doesn't
+        # return to its prompt, we kill it and start a new one.
+        grace = float(self.cfg.get('interrupt', 0))
+        if not self.maxima.is_alive():
+            self._restart_maxima("died")
+        elif self.maxima.interrupt(grace):
+            logger.info("Maxima " + str(self.name) + " timed out and was interrupted.")
+            INTERRUPTS.inc()
+            # We don't know what the computation did before
+            self.mutated = True
+        else:
+            self._restart_maxima()
 
-    def _restart_maxima(self):
+    def _restart_maxima(self, reason="timed out"):
         # Kill the Maxima and start a new one
-        logger.info("Maxima " + self.name + " timed out and will be killed.")
-        # TODO: This should go somewhere else.
-        self.process.kill()
-        self.process.wait() # Wait for the return code
-        del self.process
-        self.process = sp.Popen([self.cfg['path']] + self.options, stdin=sp.PIPE, stdout=sp.PIPE, bufsize=0, close_fds=True)
-        fcntl.fcntl(self.process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-        logger.info("Maxima " + self.name + " started with a new Maxima process.")
-        
-        self._init_maxima()
-
-    
-    def _send_to_maxima(self, line):
-        """Send a line to maxima, making sure there is a line end char at the end"""
+        logger.info("Maxima " + str(self.name) + " " + reason + " and will be replaced.")
+        RESTARTS.inc()
+        # abort() must not write to the wakeup pipe while we close it
+        with self.lock:
+            self.maxima.kill()
+
+        # Take a Maxima which is already running if there is one
+        maxima = None
+        if self.standby:
+            maxima = self.standby.take()
+        if maxima:
+            logger.info("Maxima " + str(self.name) + " took over Maxima " + maxima.name + ".")
+            maxima.set_name(self.name)
+            if self.cpus:
+                maxima.pin(self.cpus)
+        else:
+            # If this one dies while it boots, the next loop replaces it
+            maxima = MaximaProcess(self.name, self.cfg, self.cpus)
+            maxima.start()
+        with self.lock:
+            self.maxima = maxima
+        self.clean = True
+        self.mutated = False
+        self.unreset = 0
+        logger.info("Maxima " + str(self.name) + " started with a new Maxima process.")
+
+    def abort(self, request):
+        """Stop waiting for Maxima if we're still processing request.
+        Called from other threads if the client is gone.
+        """
+        with self.lock:
+            if self.current is request:
+                logger.debug("Worker %s aborts the cancelled request.", self.name)
+                self.maxima.abort()
+
+    def evaluate(self, request, stream=None, timeout=None):
+        """Send a request to Maxima and return the reply or an error.
+        Every output line is passed to stream as soon as it's there.
+        Without a timeout, the configured timeout is used.
+        """
+        # Filter request with our request filter
+        # TODO: What to do if the string isn't accepted?
+        request = self.fltr.filter(request)
+        # A standby Maxima we adopted may have another timeout
+        if timeout is None:
+            timeout = float(self.cfg['timeout'])
+
+        if not self.maxima.is_alive():
+            self._restart_maxima("died")
+
+        # Don't let a query see the labels of earlier queries
+        if not self.clean and self.fltr.uses_history(request):
+            self._reset_maxima()
 
-        # Remove whitespaces at the end and append a line end character
-        line = line.rstrip()
-        line += "\n"
+        self.clean = False
+        self.unreset += 1
+        self.maxima.queries += 1
+        if self.fltr.is_mutation(request):
+            self.mutated = True
         
-        # Send to stdin of Maxima and flush the cache
-        self.process.stdin.write(bytes(line, "UTF-8"))
-        self.process.stdin.flush()
-
-    def _get_maxima_reply(self):
-        """Read the output of Maxima"""
-
-        # Used for timeout handling
-        timeout = int(self.cfg['timeout'])
-        start_stamp = time.time()        
-        def _check_timeout():
-            if time.time() - start_stamp > timeout:
-                # Make sure the buffer is empty before we do anything
-                # like killing a thread
-                self.process.stdout.read()
-                self.process.stdout.flush()
-                raise TimeoutException
-        # This method blocks if maxima doesn't return to a input
-        # prompt. This is intended that we get a timeout if Maxima
-        # doesn't like our query
-        # Oh, and by the way: This code is ugly as hell!
-        reply = None
-        output = None
-        ready = False
-
-        logger.debug("Worker " + str(self.name) + " waits for Maxima reply.")
-        while not output:
-            _check_timeout()
-            time.sleep(.1)
-            self.process.stdout.flush()
-            output = self.process.stdout.read()
-        if output:
-            logger.debug("Worker " + str(self.name) + " received: " +  str(output, "UTF-8", "replace"))
-            reply, ready = self.parser.parse(str(output, "UTF-8", "replace"))
-
-        # Basically just repeat what we did above.
-        while not ready:
-            logger.debug("Worker " + str(self.name) + " received a partial reply.")
-            output = None
-            logger.debug("Worker " + str(self.name) + " waiting for more data from Maxima.")
-            while not output:
-                _check_timeout()
-                self.process.stdout.flush()
-                output = self.process.stdout.read()
-                time.sleep(.1)
-            if output:
-                logger.debug("Worker " + str(self.name) + " received: " + str(output, "UTF-8", "replace"))
-                reply_tmp, ready = self.parser.parse(str(output, "UTF-8", "replace"))
-                if reply_tmp and reply:
-                    reply += "\n" + reply_tmp
-                elif reply_tmp:
-                    reply = reply_tmp
-        logger.debug("Maxima " + str(self.name) + " sent full reply.")
-        # Just in case something is stuck in the buffer, we make sure it's empty
-        self.process.stdout.read()
-        self.process.stdout.flush()
-        return reply
-
-    def _init_maxima(self):
-        # Sends the init string to maxima
-        logger.debug("Maxima " + str(self.name) + " init: " + self.cfg['init'])
-        self._send_to_maxima(self.cfg['init'])
-        
-        # Read until ready
+        # Start processing stuff with maxima
+        logger.debug("Maxima %s query: %s", self.name, request)
         try:
-            self._get_maxima_reply()
+            start = time.monotonic()
+            self.maxima.send(request)
+            sent = time.monotonic()
+            SEND_TIME.observe(sent - start)
+
+            # Wait for a reply from maxima
+            reply = self.maxima.get_reply(stream, timeout, abortable=True)
+            COMPUTE_TIME.observe(time.monotonic() - sent - self.maxima.parse_time)
+            PARSE_TIME.observe(self.maxima.parse_time)
+        except ProcessDiedException:
+            CRASHES.inc()
+            # Lines which were streamed already can't be taken back
+            if stream is not None and self.maxima.parser.output:
+                return ERROR_CRASHED
+            return RETRY
         except TimeoutException:
-            logger.error("Maxima %s didn't initialize correctly!" % self.name)
+            TIMEOUTS.inc()
+            self._recover_maxima()
+            return ERROR_TIMEOUT
+        except CancelledException:
+            CANCELLED.inc()
+            self._recover_maxima()
+            return ERROR_CANCELLED
+        if self.maxima.parser.truncated:
+            logger.warn("Maxima %s: reply to %s is too large." % (self.name, request))
+            return ERROR_TOO_LARGE
+        return reply or ERROR_OUTPUT
+
+    def evaluate_batch(self, items, timeout=None):
+        """Evaluate the expressions of a batch one after the other and
+        return the joined replies. The reset policy applies between them.
+        """
+        replies = []
+        for i, item in enumerate(items):
+            if i:
+                self._reset_if_needed()
+            if self.current.cancelled:
+                replies.append(ERROR_CANCELLED)
+            elif item.strip():
+                reply = self.evaluate(item, timeout=timeout)
+                if reply is RETRY:
+                    # Try again with a new Maxima
+                    RETRIES.inc()
+                    reply = self.evaluate(item, timeout=timeout)
+                replies.append(ERROR_CRASHED if reply is RETRY else reply)
+            else:
+                replies.append(ERROR_OUTPUT)
+        return batch.join_replies(replies)
+
+    def _reset_if_needed(self):
+        if not self.maxima.is_alive():
+            # A new Maxima doesn't need a reset
+            self._restart_maxima("died")
+        elif self._needs_reset():
+            self._reset_maxima()
+        elif not self.clean:
+            self.reset_skips += 1
+            RESET_SKIPS.inc()
 
+    def _recycle_if_needed(self):
+        """Start a new Maxima in the background if ours grew too large or
+        answered too many queries. It takes over as soon as it's ready.
+        """
+        self.rss = self.maxima.rss()
+        if self.replacement:
+            return
+        if self.max_rss and self.rss > self.max_rss:
+            reason = 'rss'
+        elif self.max_queries and self.maxima.queries >= self.max_queries:
+            reason = 'queries'
+        else:
+            return
+        logger.info("Maxima %s: recycling after %d queries with %.0f MB resident memory." %
+                    (self.name, self.maxima.queries, self.rss / 1024 / 1024))
+        RECYCLES[reason].inc()
+
+        maxima = self.standby.take() if self.standby else None
+        if maxima:
+            maxima.set_name(self.name)
+            if self.cpus:
+                maxima.pin(self.cpus)
+            self._swap(maxima)
+            return
+        self.replacement = MaximaProcess(self.name, self.cfg, self.cpus)
+        self.replacement_thread = threading.Thread(target=self.replacement.start)
+        self.replacement_thread.daemon = True
+        self.replacement_thread.start()
+
+    def _swap_if_ready(self):
+        if self.replacement_thread and not self.replacement_thread.is_alive():
+            maxima = self.replacement
+            self.replacement = self.replacement_thread = None
+            self._swap(maxima)
+
+    def _swap(self, maxima):
+        """Use a new, initialized Maxima and quit the old one"""
+        old = self.maxima
+        with self.lock:
+            self.maxima = maxima
+        old.terminate()
+        self.clean = True
+        self.mutated = False
+        self.unreset = 0
+        logger.debug("Maxima %s: the new Maxima took over." % self.name)
+
+    def _needs_reset(self):
+        """Decide by the reset policy whether to reset Maxima before the next query"""
+        if self.clean:
+            return False
+        if self.mutated or self.reset_policy == 'always':
+            return True
+        if self.reset_policy == 'every':
+            return self.unreset >= self.reset_every
+        # on-mutation
+        return False
 
     def _reset_maxima(self):
         # Reset and re-init the maxima process
         # TODO: Check what we really need here.
-        self._send_to_maxima(self.cfg['reset'])
+        start = time.monotonic()
+        self.clean = True
+        self.mutated = False
+        self.unreset = 0
 
         # Read until ready
         try:
-            self._get_maxima_reply()
+            self.maxima.send(self.cfg['reset'])
+            self.maxima.get_reply()
         except TimeoutException:
-            logger.warn("Maxima %s failed to reset! Starting new instance." % self.name)
-            self._restart_maxima()
+            logger.warn("Maxima %s failed to reset!" % self.name)
+            self.clean = False
+            self._recover_maxima()
+        self.resets += 1
+        self.reset_time += time.monotonic() - start
+        RESET_TIME.observe(time.monotonic() - start)
+
+
+class RequestQueue(queue.Queue):
+    """ The queue the TCP server puts its RequestControllers into.
+    Idle workers block in get_request() until a request arrives, so
+    a request is handed to a waiting worker right away.
+
+    Requests are handed out by priority class first, then by earliest
+    deadline and then in the order they arrived. A request whose
+    deadline passed while it was queued is answered with ERROR_EXPIRED
+    and never reaches Maxima.
+    """
+
+    def __init__(self, maxsize=0, priorities=DEFAULT_PRIORITIES, default_priority='default'):
+        # The priority classes, most urgent first
+        self.priorities = list(priorities)
+        if default_priority not in self.priorities:
+            self.priorities.append(default_priority)
+        self.default_priority = default_priority
+        self.expired = 0 # Requests dropped because of their deadline
+        self.service_time = 0.0 # Average time a worker needs for a request
+        queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        # A heap of (priority, deadline, number, request)
+        self.queue = []
+        self.count = itertools.count()
+        self.depths = dict.fromkeys(self.priorities, 0)
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        # Remember when the request was queued
+        item.queued_at = time.monotonic()
+        if item.priority not in self.depths:
+            item.priority = self.default_priority
+        deadline = item.deadline if item.deadline is not None else math.inf
+        heapq.heappush(self.queue, (self.priorities.index(item.priority), deadline,
+                                    next(self.count), item))
+        self.depths[item.priority] += 1
+        item.set_on_cancel(lambda: self.cancel(item))
+
+    def _get(self):
+        item = heapq.heappop(self.queue)[3]
+        self.depths[item.priority] -= 1
+        return item
+
+    def depth(self, priority):
+        """Return the number of queued requests of a priority class"""
+        with self.mutex:
+            return self.depths[priority]
+
+    def observe_service(self, seconds):
+        """Called by the workers with the time they needed for a request"""
+        with self.mutex:
+            if self.service_time:
+                self.service_time += SERVICE_TIME_WEIGHT * (seconds - self.service_time)
+            else:
+                self.service_time = seconds
+
+    def expected_wait(self, workers):
+        """Estimate how long a new request waits until one of the
+        workers takes it.
+        """
+        with self.mutex:
+            return self._qsize() * self.service_time / max(1, workers)
+
+    def oldest_wait(self):
+        """Return how many seconds the oldest request in the queue waits"""
+        with self.mutex:
+            if not self._qsize():
+                return 0.0
+            return time.monotonic() - min(entry[3].queued_at for entry in self.queue)
+
+    def get_request(self, stop):
+        """Remove and return the next request. Blocks until there is one,
+        or returns None as soon as the stop event is set.
+        """
+        while True:
+            with self.not_empty:
+                while True:
+                    if stop.is_set():
+                        return None
+                    if self._qsize():
+                        break
+                    self.not_empty.wait()
+                item = self._get()
+                self.not_full.notify()
+            if item.deadline is None or item.deadline >= time.monotonic():
+                return item
+            self._expire(item)
+
+    def cancel(self, item):
+        """Remove a cancelled request from the queue"""
+        with self.mutex:
+            for index, entry in enumerate(self.queue):
+                if entry[3] is item:
+                    break
+            else:
+                # A worker got it already
+                return
+            self.queue[index] = self.queue[-1]
+            self.queue.pop()
+            heapq.heapify(self.queue)
+            self.depths[item.priority] -= 1
+            self.not_full.notify()
+        logger.debug("Removed cancelled request %s from the queue.", item.request.strip())
+        CANCELLED.inc()
+        item.set_error(ERROR_CANCELLED)
+        item.set_ready()
+        self.task_done()
+
+    def _expire(self, item):
+        logger.debug("Dropping request %s, its deadline passed.", item.request.strip())
+        with self.mutex:
+            self.expired += 1
+        EXPIRED.inc()
+        item.set_error(ERROR_EXPIRED)
+        item.set_ready()
+        self.task_done()
+
+    def wake_all(self):
+        """Wake up all workers waiting in get_request()"""
+        with self.not_empty:
+            self.not_empty.notify_all()
 
 
 class RequestController():
@@ -260,27 +614,128 @@ class RequestController():
         self.reply = ''
         # Store the actual request.
         self.request = request
+        # Set by the queue
+        self.queued_at = None
+        # The expressions of a batch request, None for other requests
+        self.items = None
+        # Priority class and deadline (time.monotonic()) set by the
+        # dispatcher, None means the defaults of the queue
+        self.priority = None
+        self.deadline = None
+        # Seconds Maxima may compute, None means the configured timeout
+        self.timeout = None
+        # Name of the pool the client asked for, None means the dispatcher
+        # picks one
+        self.pool = None
+        # How often the request was requeued because its Maxima died
+        self.retries = 0
+        # Set if the request timed out in the fast pool and was moved
+        # to the slow one
+        self.demoted = False
+        # Seconds the workers spent on the request
+        self.runtime = 0.0
+        # Set if nobody waits for the reply any more, on_cancel is called
+        # by cancel()
+        self.cancelled = False
+        self.on_cancel = None
+        # Set as soon as our own client is gone. Other clients may still
+        # wait for our reply, see SingleFlight.
+        self.abandoned = False
+        self.followers = 0
+        # If set, called by the worker with every output line as soon
+        # as Maxima printed it
+        self.stream = None
+        # Functions called as soon as the reply is ready
+        self.callbacks = []
+        self.lock = threading.Lock()
         
     def set_ready(self):
-        self.ready.set()
+        with self.lock:
+            self.ready.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
 
     def is_ready(self):
         return self.ready.isSet()
 
-    def wait(self):
-        self.ready.wait()
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback(controller) as soon as the reply is ready. The
+        callback runs in the worker thread, or right away if the reply
+        is already there.
+        """
+        with self.lock:
+            if not self.ready.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        """Called if the client is gone. Unless other clients wait for the
+        reply, the request is removed from the queue or the worker stops
+        waiting for Maxima.
+        """
+        with self.lock:
+            if self.ready.is_set() or self.abandoned:
+                return
+            self.abandoned = True
+            if self.followers:
+                return
+            self.cancelled = True
+            on_cancel = self.on_cancel
+        if on_cancel:
+            on_cancel()
+
+    def follow(self):
+        """Another client waits for our reply. Returns False if the
+        request was cancelled already.
+        """
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.followers += 1
+            return True
+
+    def unfollow(self):
+        """A client which waited for our reply is gone. The request is
+        cancelled once our own client is gone, too.
+        """
+        with self.lock:
+            self.followers -= 1
+            if self.followers or not self.abandoned or self.ready.is_set() or self.cancelled:
+                return
+            self.cancelled = True
+            on_cancel = self.on_cancel
+        if on_cancel:
+            on_cancel()
+
+    def set_on_cancel(self, function):
+        """Call function if the request is cancelled. Returns False if
+        the request was cancelled already.
+        """
+        with self.lock:
+            self.on_cancel = function
+            return not self.cancelled
 
     def set_reply(self, reply):
         self.reply = reply
 
+    def set_error(self, error):
+        """Answer the request with an error. A batch gets the error once
+        for every expression, so each one still has a reply of its own.
+        """
+        if self.items is not None:
+            error = batch.join_replies([error] * len(self.items))
+        self.reply = error
+
     def get_reply(self):
         return self.reply
 
             
 
-class TimeoutException(Exception):
-    pass
-
 class NoOutputException(Exception):
     pass
 
@@ -1,27 +1,29 @@
 import unittest
-import configparser
-import logging
-from queue import Queue
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 from maxima_threads import MaximaWorker
 from maxima_threads import RequestController
-from config_loader import Config
+from maxima_threads import RequestQueue
+from maxima_process import StandbyPool
+from testing import maxima_config, start_worker, quit_worker
 
 
 class MaximaWorkerTests(unittest.TestCase):
 
     def setUp(self):
-        config = Config()
-        # I only need the logger if tests fail...
-        # logging.basicConfig(level=config['General']['loglevel'])
-        # self.logger = logging.getLogger("tcp2maxima")
-
-        self.queries = Queue()
-        self.worker = MaximaWorker('testWorker', self.queries, config['Maxima'])
-        self.worker.start()
+        self.config = maxima_config()
+        self.queries = RequestQueue()
+        self.worker = start_worker(self, 'testWorker', self.config, self.queries)
 
     def tearDown(self):
+        # An idle worker has to wake up and exit right away
         self.worker.quit_worker()
+        self.worker.join(5)
+        self.assertFalse(self.worker.is_alive())
 
     def testMaximaReply(self):
         controller = RequestController('12+12;')
@@ -39,6 +41,206 @@ class MaximaWorkerTests(unittest.TestCase):
         reply = controller.get_reply()
         self.assertTrue(reply == ';ERR;TIMEOUT')
 
+    def testResetOnMutation(self):
+        worker = start_worker(self, 'resetWorker', dict(self.config, reset_policy='on-mutation'))
+
+        controllers = [RequestController(q) for q in ['2^3;', '2^3;', 'a:3$', '2^3;']]
+        for controller in controllers:
+            worker.queries.put(controller)
+            controller.wait()
+        self.assertTrue(controllers[0].get_reply() == '8')
+        self.assertTrue(controllers[3].get_reply() == '8')
+        quit_worker(worker)
+        # Only the assignment was followed by a reset, not the other three queries
+        self.assertTrue(worker.resets == 1)
+        self.assertTrue(worker.reset_skips == 3)
+
+    def testStreamAndTooLarge(self):
+        worker = start_worker(self, 'largeWorker', dict(self.config, max_reply_size='6'))
+
+        lines = []
+        controllers = [RequestController('2^3;'), RequestController('x;y;1234567;')]
+        for controller in controllers:
+            controller.stream = lines.append
+            worker.queries.put(controller)
+            controller.wait()
+        self.assertTrue(controllers[0].get_reply() == '8')
+        self.assertTrue(controllers[1].get_reply() == ';ERR;TOO_LARGE')
+        # Lines were streamed until the reply got too large
+        self.assertTrue(lines == ['8', 'x', 'y'])
+
+    def testRequestTimeout(self):
+        controller = RequestController('12^12^12^12;')
+        controller.timeout = 0.2
+        start = time.monotonic()
+        self.queries.put(controller)
+        controller.wait()
+        self.assertTrue(controller.get_reply() == ';ERR;TIMEOUT')
+        self.assertTrue(time.monotonic() - start < 0.9)
+
+    def testCancelRunning(self):
+        controllers = [RequestController('12^12^12^12;'), RequestController('12+12;')]
+        controllers[0].timeout = 30
+        for controller in controllers:
+            self.queries.put(controller)
+        time.sleep(.2)
+        start = time.monotonic()
+        controllers[0].cancel()
+        for controller in controllers:
+            controller.wait()
+        # The worker stopped waiting for Maxima right away
+        self.assertTrue(time.monotonic() - start < 5)
+        self.assertTrue(controllers[0].get_reply() == ';ERR;CANCELLED')
+        self.assertTrue(controllers[1].get_reply() == '24')
+
+    def testCrashIsRetriedOnce(self):
+        controllers = [RequestController('quit();'), RequestController('12+12;')]
+        start = time.monotonic()
+        for controller in controllers:
+            self.queries.put(controller)
+        for controller in controllers:
+            controller.wait()
+        # We didn't wait for the timeout
+        self.assertTrue(time.monotonic() - start < 1)
+        self.assertTrue(controllers[0].get_reply() == ';ERR;CRASHED')
+        self.assertTrue(controllers[0].retries == 1)
+        self.assertTrue(controllers[1].get_reply() == '24')
+
+    def testDeadWhileIdle(self):
+        self.worker.ready.wait()
+        self.worker.maxima.process.kill()
+        self.worker.maxima.process.wait()
+        controller = RequestController('12+12;')
+        self.queries.put(controller)
+        controller.wait()
+        self.assertTrue(controller.get_reply() == '24')
+        self.assertTrue(controller.retries == 0)
+
+    def _recycle(self, **settings):
+        worker = start_worker(self, 'recycleWorker', dict(self.config, **settings))
+        worker.ready.wait()
+        pid = worker.maxima.process.pid
+        for i in range(3):
+            controller = RequestController('12+12;')
+            worker.queries.put(controller)
+            controller.wait()
+            self.assertTrue(controller.get_reply() == '24')
+        # The new Maxima takes over once it's booted
+        for i in range(50):
+            if worker.maxima.process.pid != pid:
+                break
+            time.sleep(.1)
+            controller = RequestController('12+12;')
+            worker.queries.put(controller)
+            controller.wait()
+            self.assertTrue(controller.get_reply() == '24')
+        return worker.maxima.process.pid != pid
+
+    def testRecycleAfterQueries(self):
+        self.assertTrue(self._recycle(max_queries='2'))
+
+    def testRecycleOnRss(self):
+        self.assertTrue(self._recycle(max_rss='0.001'))
+
+    def testDemoteAfterTimeout(self):
+        slow = RequestQueue()
+        worker = start_worker(self, 'fastWorker', self.config, demote_to=slow)
+        controllers = [RequestController('12^12^12^12;'), RequestController('12^12^12^12;')]
+        controllers[1].timeout = 0.5
+        for controller in controllers:
+            worker.queries.put(controller)
+        worker.queries.join()
+        # Only the request without a timeout of its own gets a second try
+        self.assertFalse(controllers[0].is_ready())
+        self.assertTrue(controllers[0].demoted)
+        self.assertTrue(controllers[0].runtime >= 1)
+        self.assertTrue(slow.qsize() == 1)
+        self.assertTrue(controllers[1].get_reply() == ';ERR;TIMEOUT')
+
+    def testInterruptAfterTimeout(self):
+        worker = start_worker(self, 'interruptWorker', dict(self.config, interrupt='2'))
+        worker.ready.wait()
+        pid = worker.maxima.process.pid
+        controllers = [RequestController('12^12^12^12;'), RequestController('12+12;')]
+        for controller in controllers:
+            worker.queries.put(controller)
+        for controller in controllers:
+            controller.wait()
+        self.assertTrue(controllers[0].get_reply() == ';ERR;TIMEOUT')
+        self.assertTrue(controllers[1].get_reply() == '24')
+        # Maxima was interrupted, not replaced
+        self.assertTrue(worker.maxima.process.pid == pid)
+
+    def testStandbyAfterTimeout(self):
+        # Always kill Maxima after a timeout
+        config = dict(self.config, interrupt='0')
+        standby = StandbyPool(config, 1)
+        self.addCleanup(standby.quit)
+        standby.start()
+        worker = start_worker(self, 'standbyWorker', config, standby=standby)
+        while standby.processes.qsize() < 1:
+            time.sleep(.1)
+
+        controllers = [RequestController('12+12'), RequestController('12+12;')]
+        for controller in controllers:
+            worker.queries.put(controller)
+        for controller in controllers:
+            controller.wait()
+        self.assertTrue(controllers[0].get_reply() == ';ERR;TIMEOUT')
+        self.assertTrue(controllers[1].get_reply() == '24')
+        # The worker took the standby Maxima and a new one was started
+        self.assertTrue(worker.maxima.name == 'standbyWorker')
+        for i in range(50):
+            if standby.processes.qsize() == 1:
+                break
+            time.sleep(.1)
+        self.assertTrue(standby.count == 2)
+
+    def testBatch(self):
+        controller = RequestController(';BATCH;2^3;\t12+12\t\t12+12;')
+        controller.items = ['2^3;', '12+12', '', '12+12;']
+        self.queries.put(controller)
+        controller.wait()
+        # Every expression gets a reply of its own
+        self.assertTrue(controller.get_reply() == '8\n;NEXT;\n;ERR;TIMEOUT\n;NEXT;\n;ERR;NO_OUTPUT\n;NEXT;\n24')
+
+    def testBatchCrashes(self):
+        controller = RequestController(';BATCH;quit();\tquit();\t12+12;')
+        controller.items = ['quit();', 'quit();', '12+12;']
+        self.queries.put(controller)
+        self.assertTrue(controller.wait(10))
+        self.assertTrue(controller.get_reply() == ';ERR;CRASHED\n;NEXT;\n;ERR;CRASHED\n;NEXT;\n24')
+        self.assertTrue(self.worker.is_alive())
+
+    def testResetDeadMaxima(self):
+        # We don't start the worker thread, it would replace the dead
+        # Maxima on its own
+        worker = MaximaWorker('resetWorker', RequestQueue(), self.config)
+        self.addCleanup(lambda: worker.maxima.kill())
+        maxima = worker.maxima
+        maxima.start()
+        maxima.process.kill()
+        maxima.process.wait()
+        # The reset fails, the worker replaces its Maxima
+        worker._reset_maxima()
+        self.assertTrue(worker.maxima is not maxima)
+        self.assertTrue(worker.maxima.is_alive())
+
+    def testReplacementDiesWhileBooting(self):
+        # Exits right after the first prompt and doesn't take the init
+        path = os.path.join(tempfile.mkdtemp(), 'maxima')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write("#!/bin/sh\nexec 0<&-\nprintf '(%%i1) '\nexit 1\n")
+        os.chmod(path, 0o755)
+        worker = MaximaWorker('bootWorker', RequestQueue(), self.config)
+        self.addCleanup(lambda: worker.maxima.kill())
+        worker.maxima.start()
+        worker.cfg = dict(self.config, path=path, core='')
+        # The worker thread would try again in its next loop
+        worker._restart_maxima("died")
+        self.assertFalse(worker.maxima.is_alive())
+
     def testNoOutput(self):
         controller = RequestController(';')
         self.queries.put(controller)
@@ -72,6 +274,58 @@ class MaximaWorkerTests(unittest.TestCase):
             reply = rep.get_reply()
             self.assertTrue(reply == ';ERR;TIMEOUT')
 
+class RequestQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = RequestQueue()
+        self.stop = threading.Event()
+
+    def request(self, query, priority=None, deadline=None):
+        controller = RequestController(query)
+        controller.priority = priority
+        if deadline is not None:
+            controller.deadline = time.monotonic() + deadline
+        self.queries.put(controller)
+        return controller
+
+    def testPriorityThenDeadline(self):
+        self.request('1;', 'bulk')
+        self.request('2;')
+        self.request('3;', 'default', 10)
+        self.request('4;', 'interactive')
+        self.request('5;', 'default', 5)
+        self.assertEqual(self.queries.depth('default'), 3)
+        order = [self.queries.get_request(self.stop).request for i in range(5)]
+        self.assertEqual(order, ['4;', '5;', '3;', '2;', '1;'])
+
+    def testUnknownPriority(self):
+        self.request('1;', 'urgent')
+        self.assertEqual(self.queries.depth('default'), 1)
+
+    def testCancelQueued(self):
+        cancelled = self.request('1;')
+        self.request('2;')
+        cancelled.cancel()
+        self.assertEqual(cancelled.get_reply(), ';ERR;CANCELLED')
+        self.assertEqual(self.queries.qsize(), 1)
+        self.assertEqual(self.queries.get_request(self.stop).request, '2;')
+
+    def testExpectedWait(self):
+        self.queries.observe_service(1.0)
+        self.queries.observe_service(2.0)
+        self.assertAlmostEqual(self.queries.service_time, 1.1)
+        for i in range(4):
+            self.request('1;')
+        self.assertAlmostEqual(self.queries.expected_wait(2), 2.2)
+
+    def testExpired(self):
+        expired = self.request('1;', deadline=-1)
+        self.request('2;')
+        self.assertEqual(self.queries.get_request(self.stop).request, '2;')
+        self.assertTrue(expired.is_ready())
+        self.assertEqual(expired.get_reply(), ';ERR;EXPIRED')
+        self.assertEqual(self.queries.expired, 1)
+
 def main():
     unittest.main()
 
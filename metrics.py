@@ -0,0 +1,184 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Metrics about what tcp2maxima is doing. They are collected in the
+# module wide REGISTRY and served over HTTP in the Prometheus text format
+# by the MetricsServer.
+
+import bisect
+import http.server
+import logging
+import threading
+
+logger = logging.getLogger("tcp2maxima")
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, value) for key, value in items) + '}'
+
+
+class Counter:
+    """ A value which only goes up """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels) + ' ' + repr(self.value)
+
+
+class Gauge:
+    """ A value which is read from a function whenever the metrics are
+    rendered. Used for things other objects count anyway.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels) + ' ' + repr(self.function())
+
+
+class Histogram:
+    """ Counts observed durations in buckets """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield name + '_bucket' + _format_labels(labels, ('le', repr(bound))) + ' ' + str(cumulative)
+        cumulative += counts[-1]
+        yield name + '_bucket' + _format_labels(labels, ('le', '+Inf')) + ' ' + str(cumulative)
+        yield name + '_sum' + _format_labels(labels) + ' ' + repr(total)
+        yield name + '_count' + _format_labels(labels) + ' ' + str(cumulative)
+
+
+class Registry:
+    """ All metrics, by name and labels """
+
+    def __init__(self):
+        # name -> (type, help, {labels: metric})
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, documentation, labels, factory):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            family = self.metrics.setdefault(name, (kind, documentation, {}))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, documentation, labels=None):
+        return self._get('counter', name, documentation, labels, Counter)
+
+    def histogram(self, name, documentation, labels=None):
+        return self._get('histogram', name, documentation, labels, Histogram)
+
+    def gauge(self, name, documentation, function, labels=None, kind='gauge'):
+        """Register a function which returns the value of the metric.
+        Use kind='counter' for values which only go up.
+        """
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            family = self.metrics.setdefault(name, (kind, documentation, {}))
+            family[2][key] = Gauge(function)
+
+    def remove(self, name, labels=None):
+        """Remove a metric, e.g. of a worker which is gone"""
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            if name in self.metrics:
+                self.metrics[name][2].pop(key, None)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        with self.lock:
+            families = [(name, kind, documentation, list(metrics.items()))
+                        for name, (kind, documentation, metrics) in sorted(self.metrics.items())]
+        lines = []
+        for name, kind, documentation, metrics in families:
+            lines.append('# HELP %s %s' % (name, documentation))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in metrics:
+                lines.extend(metric.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+
+# The registry used by all modules
+REGISTRY = Registry()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = bytes(self.server.registry.render(), 'UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format % args)
+
+
+class MetricsServer(http.server.HTTPServer):
+    """ Serves the metrics on http://address:port/metrics """
+
+    def __init__(self, server_address, registry=REGISTRY):
+        http.server.HTTPServer.__init__(self, server_address, MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,45 @@
+import unittest
+import urllib.request
+
+from metrics import Registry, MetricsServer
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def testHistogram(self):
+        histogram = self.registry.histogram('wait_seconds', 'Wait')
+        histogram.observe(0.003)
+        histogram.observe(0.2)
+        text = self.registry.render()
+        self.assertIn('# TYPE wait_seconds histogram', text)
+        self.assertIn('wait_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('wait_seconds_count 2', text)
+
+    def testCounterAndGauge(self):
+        self.registry.counter('timeouts_total', 'Timeouts').inc()
+        self.registry.gauge('workers', 'Workers', lambda: 3, labels={'state': 'idle'})
+        text = self.registry.render()
+        self.assertIn('timeouts_total 1', text)
+        self.assertIn('workers{state="idle"} 3', text)
+
+    def testServer(self):
+        self.registry.counter('timeouts_total', 'Timeouts').inc(2)
+        server = MetricsServer(('localhost', 0), self.registry)
+        server.start()
+        try:
+            url = 'http://localhost:%d/metrics' % server.server_address[1]
+            text = str(urllib.request.urlopen(url).read(), 'UTF-8')
+            self.assertIn('timeouts_total 2', text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -24,46 +24,101 @@ import logging
 logger = logging.getLogger("tcp2maxima")
 
 class ReplyParser:
+    """Parses the output of Maxima while it arrives.
 
-    def __init__(self, thread_name):
+    The output is fed in chunks as it is read from the pipe. Complete
+    lines are parsed once, a line or a prompt which is split between two
+    chunks stays in the buffer until the rest arrives. That way the time
+    needed to parse a reply grows linearly with its size.
+    """
+
+    def __init__(self, thread_name, max_size=0):
+        # Output beyond max_size bytes is dropped, 0 means no limit
+        self.max_size = max_size
         # Matches strings which are marked as output
-        self.output_re = re.compile(r"^(\(%o\d+\))( *)(.*)")
+        self.output_re = re.compile(rb"^\(%o\d+\) *(.*)$")
         # Matches input promts which are not followed by a message
-        self.input_re = re.compile(r"^\(%i\d+\) $")
+        self.input_re = re.compile(rb"^\(%i\d+\) $")
         self.thread = thread_name
+        self.reset()
 
-    def parse(self, string):
-        """Return the type of a line
-        
-        Return the constant and the relevant part of the line
+    def reset(self):
+        """Forget everything, used before we wait for a new reply"""
+        self.buffer = bytearray()
+        self.scan = 0 # We didn't find a line end before this position
+        self.output = [] # The output lines of the reply
+        self.ready = False # Set if we saw the input prompt
+        self.size = 0 # Size of the output in bytes
+        self.truncated = False # Set if the output was larger than max_size
+        self.skip_line = False # Drop everything up to the next line end
+
+    def feed(self, data):
+        """Parse a chunk of Maxima output.
+
+        Returns the list of the output lines completed by this chunk and
+        True if Maxima returned to the input prompt. The prompt is only
+        reported by the first call which sees it.
         """
-        
-        # Get a list of lines
-        lines = string.splitlines()
-        # Will be set to true if the string ends with a input prompt
-        ready = False 
-        output = None # A string containing the actual output
-        messages = [] # A list containing all messages which are not marked as output
-        for line in lines:
-            if self.output_re.match(line):
-                # TODO: If  I get a empty reply this fails with a exception
-                if output:
-                    output += "\n"
-                    output += self.output_re.match(line).group(3)
-                else:
-                    output = self.output_re.match(line).group(3)
-        
-                #except
-            elif self.input_re.match(line):
-                ready = True
-            else:
-                messages.append(line)
+        buf = self.buffer
+        buf += data
+        lines = []
+        prompt = False
+        start = 0
+        while True:
+            end = buf.find(b"\n", self.scan)
+            if end < 0:
+                break
+            if self.skip_line:
+                # The rest of a line which was too long
+                self.skip_line = False
+            elif self._parse_line(bytes(buf[start:end]).rstrip(b"\r"), lines):
+                prompt = True
+            start = self.scan = end + 1
+        if start:
+            del buf[:start]
+        if self.max_size and len(buf) > self.max_size and not self.input_re.match(buf):
+            # Don't buffer a line which is too long anyway
+            self.truncated = self.skip_line = True
+            del buf[:]
+        self.scan = len(buf)
 
-        self._log_messages(messages)
-        return output, ready
+        # The input prompt isn't followed by a line end
+        if buf[0:2] == b"(%" and self.input_re.match(buf):
+            prompt = True
+        if prompt and not self.ready:
+            self.ready = True
+            return lines, True
+        return lines, False
 
-    def _log_messages(self, messages):
-        for i in messages:
-            if i != '':
-                logger.debug("Maxima " + str(self.thread) + " message: " + i)
+    def reply(self):
+        """Return the output of the whole reply or None if there was none"""
+        if not self.output:
+            return None
+        return "\n".join(self.output)
+
+    def parse(self, string):
+        """Parse a complete chunk of output at once. Returns the output and
+        whether it ends with a input prompt.
+        """
+        self.reset()
+        lines, ready = self.feed(bytes(string, "UTF-8"))
+        return self.reply(), ready
 
+    def _parse_line(self, line, lines):
+        """Parse a complete line. Returns True if it's a input prompt."""
+        match = self.output_re.match(line)
+        if match:
+            self.size += len(match.group(1))
+            if self.max_size and self.size > self.max_size:
+                self.truncated = True
+            if self.truncated:
+                return False
+            text = str(match.group(1), "UTF-8", "replace")
+            self.output.append(text)
+            lines.append(text)
+        elif self.input_re.match(line):
+            # A prompt followed by a line end, e.g. from a multi line input
+            return True
+        elif line and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Maxima " + str(self.thread) + " message: " + str(line, "UTF-8", "replace"))
+        return False
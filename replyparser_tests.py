@@ -0,0 +1,68 @@
+import unittest
+
+from replyparser import ReplyParser
+
+
+class ReplyParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ReplyParser('test')
+
+    def testReply(self):
+        lines, ready = self.parser.feed(b'(%o1) 24\n(%i2) ')
+        self.assertEqual(lines, ['24'])
+        self.assertTrue(ready)
+        self.assertEqual(self.parser.reply(), '24')
+
+    def testSplitOutputLine(self):
+        self.assertEqual(self.parser.feed(b'(%o1'), ([], False))
+        self.assertEqual(self.parser.feed(b'2) x^2+'), ([], False))
+        self.assertEqual(self.parser.feed(b'1\n(%o13) 2\n'), (['x^2+1', '2'], False))
+        self.assertEqual(self.parser.reply(), 'x^2+1\n2')
+
+    def testSplitPrompt(self):
+        self.assertEqual(self.parser.feed(b'(%o1) 8\n(%i'), (['8'], False))
+        self.assertEqual(self.parser.feed(b'2'), ([], False))
+        self.assertEqual(self.parser.feed(b') '), ([], True))
+
+    def testSplitCharacter(self):
+        data = bytes('(%o1) π\n(%i2) ', 'UTF-8')
+        self.parser.feed(data[:8])
+        self.parser.feed(data[8:])
+        self.assertEqual(self.parser.reply(), 'π')
+
+    def testReadyOnlyOnce(self):
+        self.assertEqual(self.parser.feed(b'(%i1) '), ([], True))
+        self.assertEqual(self.parser.feed(b''), ([], False))
+
+    def testMessages(self):
+        lines, ready = self.parser.feed(b'rat: replaced 0.5 by 1/2 = 0.5\n(%o1) x/2\n(%i2) ')
+        self.assertEqual(lines, ['x/2'])
+        self.assertTrue(ready)
+
+    def testNoOutput(self):
+        self.parser.feed(b'(%i2) ')
+        self.assertEqual(self.parser.reply(), None)
+
+    def testTruncated(self):
+        parser = ReplyParser('test', 8)
+        lines, ready = parser.feed(b'(%o1) 1234\n(%o2) 56789\n(%i3) ')
+        self.assertEqual(lines, ['1234'])
+        self.assertTrue(ready)
+        self.assertTrue(parser.truncated)
+
+    def testLongLineIsDropped(self):
+        parser = ReplyParser('test', 8)
+        parser.feed(b'(%o1) ' + b'x' * 100)
+        self.assertEqual(len(parser.buffer), 0)
+        self.assertEqual(parser.feed(b'xx\n(%i2) '), ([], True))
+        self.assertTrue(parser.truncated)
+
+    def testParse(self):
+        self.assertEqual(self.parser.parse('(%o1) 24\n(%i2) '), ('24', True))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
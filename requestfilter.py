@@ -17,6 +17,39 @@
 #    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import re
+
+# Requests containing one of these change the state of Maxima:
+# Assignments and function definitions (:, ::, :=, ::=), Lisp escapes
+# (?setq(...), :lisp) and functions which declare or define something,
+# set an option or load packages.
+MUTATION_RE = re.compile(r":|\?\s*\w|\b(\w*declare\w*|define\w*|set_\w*|"
+                         r"assume|forget|load|loadfile|batch|batchload|remarray|"
+                         r"kill|remvalue|remfunction|remove|put|qput|defrule|"
+                         r"tellsimp|tellsimpafter|let|gradef|depends|alias|array|atvalue|"
+                         r"infix|prefix|postfix|nary|matchfix|nofix|texput|tellrat|"
+                         r"ordergreat|orderless|unorder|activate|deactivate|newcontext|"
+                         r"supcontext|context|setup_autoload|ratweight)\s*\(")
+
+# Requests containing one of these read the input and output history,
+# e.g. %, %o3, %i2 or %th(2)
+HISTORY_RE = re.compile(r"%(?![a-zA-Z_])|%[io]\d|%th\b|\blabels\b|\b__?\b|\blinenum\b")
+
+
+# Options a client can put in front of a query, e.g.
+#   ;OPTIONS priority=interactive deadline=2.5;integrate(x,x);
+OPTIONS_RE = re.compile(r"^;OPTIONS((?:\s+\w+=[^\s;]*)*)\s*;")
+
+
+def split_options(request):
+    """Remove the options from the start of a request. Returns a dict
+    of the options and the rest of the request.
+    """
+    match = OPTIONS_RE.match(request)
+    if not match:
+        return {}, request
+    options = dict(item.split('=', 1) for item in match.group(1).split())
+    return options, request[match.end():]
 
 
 class RequestFilter:
@@ -40,3 +73,15 @@ class RequestFilter:
             string = fltr(string)
 
         return string
+
+    def is_mutation(self, string):
+        """Return True if the request might leave some state behind
+        in Maxima, e.g. a variable or a function definition.
+        """
+        return MUTATION_RE.search(string) is not None
+
+    def uses_history(self, string):
+        """Return True if the request reads the input or output labels of
+        earlier requests.
+        """
+        return HISTORY_RE.search(string) is not None
@@ -0,0 +1,39 @@
+import unittest
+
+from requestfilter import RequestFilter, split_options
+
+
+class RequestFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fltr = RequestFilter()
+
+    def testFilterNewlines(self):
+        self.assertEqual(self.fltr.filter('12+12;\n'), '12+12;')
+
+    def testMutation(self):
+        for request in ['a:3;', 'f(x):=x^2;', 'declare(n, integer)$', 'load(draw)$', 'kill(all);',
+                        'define_variable(x, 5, fixnum)$', 'mode_declare(x, fixnum)$',
+                        'set_random_state(make_random_state(42))$', 'remarray(a)$',
+                        '?setq(x, 5)$', ':lisp (setq $x 5)']:
+            self.assertTrue(self.fltr.is_mutation(request), request)
+        for request in ['2^3;', 'integrate(sin(x), x);', 'is(equal(a, b));']:
+            self.assertFalse(self.fltr.is_mutation(request), request)
+
+    def testHistory(self):
+        for request in ['%;', '%o3+1;', '%th(2);', 'labels;']:
+            self.assertTrue(self.fltr.uses_history(request), request)
+        for request in ['%pi+%i;', 'diff(%e^x, x);', 'x_1+x_2;']:
+            self.assertFalse(self.fltr.uses_history(request), request)
+
+    def testOptions(self):
+        self.assertEqual(split_options(';OPTIONS priority=bulk deadline=2.5;2^3;\n'),
+                         ({'priority': 'bulk', 'deadline': '2.5'}, '2^3;\n'))
+        self.assertEqual(split_options(';OPTIONS;;BATCH;1;'), ({}, ';BATCH;1;'))
+        self.assertEqual(split_options('2^3;'), ({}, '2^3;'))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
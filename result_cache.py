@@ -0,0 +1,116 @@
+# This file is part of tcp2maxima.
+#
+#    Copyright (c) 2013 Beni Keller
+#    Distributed under the GNU GPL v3. For full terms see the file gpl.txt.
+#
+#    tcp2maxima is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    tcp2maxima is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with tcp2maxima.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import threading
+import time
+
+import maxima_threads
+
+
+class ResultCache:
+    """ A cache for Maxima replies. It holds at most size replies and
+    throws away the least recently used one if it's full. A reply is
+    only valid for ttl seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Maps requests to (expiry time, reply) in LRU order
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, request):
+        """Return the cached reply to request or None"""
+        with self.lock:
+            entry = self.entries.get(request)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(request)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[request]
+            self.misses += 1
+            return None
+
+    def put(self, request, reply):
+        """Store a reply. Errors and empty replies are never stored."""
+        if not reply or reply.startswith(';ERR;') or self.size <= 0:
+            return
+        with self.lock:
+            self.entries[request] = (time.monotonic() + self.ttl, reply)
+            self.entries.move_to_end(request)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SingleFlight:
+    """ Keeps track of the requests which are queued or processed at the
+    moment. An identical request which comes in meanwhile doesn't go to
+    Maxima, it waits for the first one and gets the same reply. The first
+    one is only cancelled once all clients waiting for it are gone.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        # Maps requests to the RequestController which is processed
+        self.leaders = {}
+        self.lock = threading.Lock()
+
+    def join(self, request, controller):
+        """Attach controller to an identical request in flight and return
+        True. If there is none, controller is the one to process and we
+        return False.
+        """
+        with self.lock:
+            leader = self.leaders.get(request)
+            if leader is not None and not leader.follow():
+                # Everybody who waited for it is gone
+                leader = None
+            if leader is None:
+                self.leaders[request] = controller
+            else:
+                self.coalesced += 1
+
+        if leader is None:
+            controller.add_done_callback(lambda c: self._done(request, c))
+            return False
+
+        def _share_reply(leader):
+            if not controller.is_ready():
+                controller.set_reply(leader.get_reply())
+                controller.set_ready()
+        def _leave():
+            leader.unfollow()
+            controller.set_reply(maxima_threads.ERROR_CANCELLED)
+            controller.set_ready()
+        controller.set_on_cancel(_leave)
+        leader.add_done_callback(_share_reply)
+        return True
+
+    def _done(self, request, controller):
+        with self.lock:
+            if self.leaders.get(request) is controller:
+                del self.leaders[request]
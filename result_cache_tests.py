@@ -0,0 +1,111 @@
+import unittest
+import time
+
+from maxima_threads import RequestController, RequestQueue
+from result_cache import ResultCache, SingleFlight
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(2, 60)
+
+    def testHitAndMiss(self):
+        self.assertEqual(self.cache.get('12+12;'), None)
+        self.cache.put('12+12;', '24')
+        self.assertEqual(self.cache.get('12+12;'), '24')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testLeastRecentlyUsed(self):
+        self.cache.put('1;', '1')
+        self.cache.put('2;', '2')
+        self.cache.get('1;')
+        self.cache.put('3;', '3')
+        self.assertEqual(self.cache.get('2;'), None)
+        self.assertEqual(self.cache.get('1;'), '1')
+        self.assertEqual(len(self.cache), 2)
+
+    def testExpiry(self):
+        cache = ResultCache(2, 0.05)
+        cache.put('1;', '1')
+        time.sleep(0.1)
+        self.assertEqual(cache.get('1;'), None)
+        self.assertEqual(len(cache), 0)
+
+    def testErrorsAreNotCached(self):
+        self.cache.put('12^12^12^12;', ';ERR;TIMEOUT')
+        self.cache.put(';', ';ERR;NO_OUTPUT')
+        self.cache.put('x;', '')
+        self.assertEqual(len(self.cache), 0)
+
+class SingleFlightTests(unittest.TestCase):
+
+    def testIdenticalRequestsShareReply(self):
+        inflight = SingleFlight()
+        first = RequestController('2^3;')
+        second = RequestController('2^3;')
+        self.assertFalse(inflight.join('2^3;', first))
+        self.assertTrue(inflight.join('2^3;', second))
+        self.assertFalse(second.is_ready())
+
+        first.set_reply('8')
+        first.set_ready()
+        self.assertTrue(second.is_ready())
+        self.assertEqual(second.get_reply(), '8')
+        self.assertEqual(inflight.coalesced, 1)
+
+    def testFinishedRequestsAreForgotten(self):
+        inflight = SingleFlight()
+        first = RequestController('2^3;')
+        inflight.join('2^3;', first)
+        first.set_ready()
+        self.assertFalse(inflight.join('2^3;', RequestController('2^3;')))
+
+    def testLeaderKeptForFollowers(self):
+        inflight = SingleFlight()
+        queries = RequestQueue()
+        first = RequestController('2^3;')
+        second = RequestController('2^3;')
+        inflight.join('2^3;', first)
+        queries.put(first)
+        inflight.join('2^3;', second)
+
+        # The first client is gone, the second one still waits
+        first.cancel()
+        first.cancel()
+        self.assertFalse(first.cancelled)
+        self.assertTrue(queries.qsize() == 1)
+
+        # Now nobody waits any more
+        second.cancel()
+        self.assertTrue(second.get_reply() == ';ERR;CANCELLED')
+        self.assertTrue(first.cancelled)
+        self.assertTrue(queries.qsize() == 0)
+        self.assertTrue(first.get_reply() == ';ERR;CANCELLED')
+
+    def testFollowerLeaves(self):
+        inflight = SingleFlight()
+        first = RequestController('2^3;')
+        second = RequestController('2^3;')
+        inflight.join('2^3;', first)
+        inflight.join('2^3;', second)
+        second.cancel()
+        self.assertTrue(second.is_ready())
+        self.assertFalse(first.cancelled)
+        first.set_reply('8')
+        first.set_ready()
+        self.assertTrue(second.get_reply() == ';ERR;CANCELLED')
+
+    def testCancelledLeaderIsReplaced(self):
+        inflight = SingleFlight()
+        first = RequestController('2^3;')
+        inflight.join('2^3;', first)
+        first.cancel()
+        # A new request doesn't wait for a request nobody computes
+        self.assertFalse(inflight.join('2^3;', RequestController('2^3;')))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,6 @@
 
 import argparse
 import os
-import queue
 import signal
 import threading
 import sys
@@ -31,6 +30,7 @@ import logging
 
 from daemon import Daemon
 from config_loader import Config
+import metrics
 
 __version__ = '0.1.1'
 
@@ -61,8 +61,11 @@ sys.excepthook = exception_handler
 signal_count = 0
 
 # These depend on the logger we just configured
-from maxima_threads import MaximaWorker
-from tcp_server import ThreadedTCPServer, RequestHandler
+from maxima_threads import RequestQueue
+from dispatcher import Dispatcher
+from maxima_pool import MaximaPool
+from maxima_process import StandbyPool, build_core, parse_cpus
+from tcp_server import ThreadedTCPServer, AsyncTCPServer, RequestHandler
 
 ########################################
 ### Configure command line arguments ###
@@ -100,8 +103,19 @@ class App(Daemon):
         # Initialize Maxima supervisor
         self.mxcfg = config['Maxima']
 
-        # Queue used to send request to the maxima instances
-        self.queries = queue.Queue()      
+        # Decides what happens to the requests, the pools are set in run()
+        self.dispatcher = Dispatcher(config)
+        self.queries = self.dispatcher.queries
+        self.slow_queries = self.dispatcher.slow_queries
+        self.slow_threads = self.dispatcher.slow_threads
+        # Pools with options of their own from the [Pool:name] sections,
+        # the pools are started in run()
+        self.pool_sections = dict((section[len('Pool:'):], config[section])
+                                  for section in config.sections() if section.startswith('Pool:'))
+        for name in ('default', 'slow'):
+            if self.pool_sections.pop(name, None) is not None:
+                logger.warn("Ignoring [Pool:%s], the name is used by the pools of [Maxima]." % name)
+        self.pools = self.dispatcher.pools
 
     # This handler should handle SIGINT and SIGTERM
     # to gracefully exit the threads.
@@ -130,16 +144,76 @@ class App(Daemon):
         srvcfg = config['Server']
         self.host, self.port = srvcfg['address'], int(srvcfg['port'])
 
-        # Create a simple request factory on the spot
-        mycallback = lambda controller: self.queries.put(controller)
-        get_handler = lambda *args, **keys: RequestHandler(mycallback, *args, **keys)
-        self.server = ThreadedTCPServer((self.host, self.port), get_handler)
-
-        logger.info("Starting " + self.mxcfg['threads'] + " Maxima threads.")
-        self.workers = [MaximaWorker(i, self.queries, self.mxcfg) for i in range(int(self.mxcfg['threads']))]
-        for worker in self.workers:
-            worker.setDaemon(True) 
-            worker.start() 
+        mycallback = self.dispatcher.dispatch
+        if srvcfg.get('mode', 'threading') == 'asyncio':
+            self.server = AsyncTCPServer((self.host, self.port), mycallback,
+                                         backlog=int(srvcfg.get('backlog', 1024)))
+        else:
+            # Create a simple request factory on the spot
+            get_handler = lambda *args, **keys: RequestHandler(mycallback, *args, **keys)
+            self.server = ThreadedTCPServer((self.host, self.port), get_handler)
+        self.server.keepalive = srvcfg.getboolean('keepalive', False)
+        self.server.pipeline = int(srvcfg.get('pipeline', 64))
+        self.server.terminator = srvcfg.get('terminator', self.server.terminator)
+        self.server.streaming = srvcfg.getboolean('streaming', False)
+        self.server.cancel_on_eof = srvcfg.getboolean('cancel_on_eof', False)
+
+        # Keep the server threads and Maxima on different CPUs. The threads
+        # we start from now on inherit the CPUs of this one.
+        server_cpus = parse_cpus(srvcfg.get('cpus', ''))
+        if server_cpus:
+            if not self.mxcfg.get('cpus', ''):
+                others = sorted(os.sched_getaffinity(0) - set(server_cpus))
+                self.mxcfg['cpus'] = ','.join(str(cpu) for cpu in others)
+            logger.info("Server on CPUs %s, Maxima on CPUs %s." % (srvcfg['cpus'], self.mxcfg['cpus']))
+            os.sched_setaffinity(0, server_cpus)
+
+        # A saved core with our initialization makes starting Maxima faster
+        if self.mxcfg.getboolean('build_core', False):
+            build_core(self.mxcfg)
+
+        # Maxima processes waiting to replace one which timed out
+        self.standby = StandbyPool(self.mxcfg, int(self.mxcfg.get('standby', 0)))
+        if self.standby.size > 0:
+            logger.info("Starting " + str(self.standby.size) + " standby Maxima processes.")
+            self.standby.start()
+
+        # The workers boot at the same time. We start listening as soon
+        # as the first one is ready, the others join the pool later.
+        start = time.monotonic()
+        self.pool = MaximaPool(self.queries, self.mxcfg, self.standby, demote_to=self.slow_queries)
+        self.pool.start_workers()
+        if self.slow_queries is not None:
+            slowcfg = dict(self.mxcfg)
+            slowcfg.update({'timeout': self.mxcfg.get('slow_timeout', str(self.dispatcher.max_timeout)),
+                            'min_workers': str(self.slow_threads),
+                            'max_workers': str(self.slow_threads)})
+            self.slow_pool = MaximaPool(self.slow_queries, slowcfg, self.standby, name='slow')
+            self.slow_pool.start_workers()
+        for name, section in self.pool_sections.items():
+            self.pools[name] = self.start_pool(name, section)
+        self.dispatcher.pool = self.pool
+        if self.slow_queries is not None:
+            self.dispatcher.slow_pool = self.slow_pool
+        # Wake up now and then, we may be asked to quit while we wait
+        while not self.pool.wait_ready(timeout=1):
+            if not self.pool.workers:
+                logger.critical("None of the Maxima workers started, check path and options in [Maxima].")
+                self.quit_pools()
+                sys.exit(1)
+            if self.stopping:
+                self.quit_pools()
+                return
+        logger.info("First Maxima worker ready after %.2f s." % (time.monotonic() - start))
+        self.pool.start()
+        for pool in self.pools.values():
+            pool.start()
+
+        metcfg = config['Metrics']
+        if int(metcfg['port']):
+            logger.info("Serving metrics on " + metcfg['address'] + " port " + metcfg['port'])
+            self.metrics_server = metrics.MetricsServer((metcfg['address'], int(metcfg['port'])))
+            self.metrics_server.start()
 
         logger.info("Starting TCP server on " + self.host + " listening to port " + str(self.port))
         # Cant shut down the server, that's why I create a thread for now.
@@ -157,10 +231,48 @@ class App(Daemon):
 
         # Quitting after tcp server shutdown
         self.queries.join()
-        logger.debug("Quitting the Maxima workers.")
-        for worker in self.workers:
-            worker.quit_worker()
-            worker.join() 
+        if self.slow_queries is not None:
+            self.slow_queries.join()
+        for pool in self.pools.values():
+            pool.queries.join()
+        self.quit_pools()
+        dispatcher = self.dispatcher
+        if dispatcher.cache.size > 0:
+            logger.info("Cache hits: %d, misses: %d" % (dispatcher.cache.hits, dispatcher.cache.misses))
+        if dispatcher.coalesce:
+            logger.info("Coalesced requests: %d" % dispatcher.inflight.coalesced)
+        rejected = sum(counter.value for counter in dispatcher.rejected.values())
+        if rejected:
+            logger.info("Requests rejected because of the load: %d" % rejected)
+        if self.queries.expired:
+            logger.info("Requests dropped after their deadline: %d" % self.queries.expired)
+
+    def quit_pools(self):
+        """Quit the workers of all pools and the standby processes"""
+        self.pool.quit()
+        if self.slow_queries is not None:
+            self.slow_pool.quit()
+        for pool in self.pools.values():
+            pool.quit()
+        self.standby.quit()
+
+    def start_pool(self, name, section):
+        """Start the workers of a [Pool:name] section. Options the section
+        doesn't set are taken from [Maxima].
+        """
+        cfg = dict(self.mxcfg)
+        cfg.update(section)
+        if 'core' in self.mxcfg and 'core' not in section:
+            # The core of [Maxima] is saved with another initialization
+            cfg['core'] = self.mxcfg['core'] + '.' + name
+        if section.getboolean('build_core', self.mxcfg.getboolean('build_core', False)):
+            build_core(cfg)
+        queries = RequestQueue(priorities=self.queries.priorities,
+                               default_priority=self.queries.default_priority)
+        # The standby processes are initialized for the default pool
+        pool = MaximaPool(queries, cfg, name=name)
+        pool.start_workers()
+        return pool
         
 
 if __name__ == "__main__":
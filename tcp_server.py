@@ -20,15 +20,215 @@
 # Remark: At the moment this module doesn't do any logging.
 # That's because it wasn't needed yet. I might add this later.
 
+import asyncio
+import queue
+import select
+import socket
 import socketserver
 import threading
 import time
 
 from maxima_threads import RequestController
 
+# Longest query the asyncio server accepts
+MAX_QUERY_SIZE = 1024 * 1024
+
+# Line sent after every reply on a keep-alive or streaming connection
+REPLY_TERMINATOR = ';END;'
+
+# Seconds between two checks whether a waiting client is still there
+DISCONNECT_POLL = 0.1
+
+
+def frame_reply(reply, terminator, streamed=False):
+    """Return the bytes we send for a reply on a keep-alive or streaming
+    connection. Every reply is followed by a line containing only the
+    terminator. If the output lines were streamed already, only an error
+    is sent before the terminator.
+    """
+    if reply and (not streamed or reply.startswith(';ERR;')):
+        return bytes(reply + '\n' + terminator + '\n', 'UTF-8')
+    return bytes(terminator + '\n', 'UTF-8')
+
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+    # Keep connections open for many queries
+    keepalive = False
+    # Maximum number of queries per connection waiting for their reply
+    pipeline = 64
+    terminator = REPLY_TERMINATOR
+    # Send output lines as soon as Maxima printed them
+    streaming = False
+    # Cancel a single query as soon as the client closes its sending side
+    cancel_on_eof = False
+
+class AsyncTCPServer():
+    """ A TCP server which handles all connections on one asyncio event
+    loop. It speaks the same protocol as the ThreadedTCPServer with the
+    RequestHandler, but a waiting client doesn't cost a thread.
+    """
+
+    # These work like the ones of the ThreadedTCPServer
+    keepalive = False
+    pipeline = 64
+    terminator = REPLY_TERMINATOR
+    streaming = False
+    cancel_on_eof = False
+
+    def __init__(self, server_address, callback, backlog=1024):
+        # callback is a function which accepts a request controller
+        self.server_address = server_address
+        self.callback = callback
+        self.backlog = backlog
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called"""
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    def shutdown(self):
+        """Stop the server. This can be called from any thread."""
+        self.started.wait()
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    async def _serve(self):
+        host, port = self.server_address
+        self.server = await asyncio.start_server(self.handle, host, port,
+                                                 backlog=self.backlog,
+                                                 limit=MAX_QUERY_SIZE)
+        self.started.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def submit(self, query):
+        """Pass a query on to the Maxima workers. Returns the controller,
+        a future which is done as soon as the reply is ready and, in
+        streaming mode, a queue which gets the output lines followed by None.
+        """
+        future = self.loop.create_future()
+        lines = asyncio.Queue() if self.streaming else None
+        def _done(controller):
+            if lines is not None:
+                self.loop.call_soon_threadsafe(lines.put_nowait, None)
+            self.loop.call_soon_threadsafe(_set_result, future, controller)
+        controller = RequestController(query)
+        if lines is not None:
+            controller.stream = lambda line: self.loop.call_soon_threadsafe(lines.put_nowait, line)
+        controller.add_done_callback(_done)
+        self.callback(controller)
+        return controller, future, lines
+
+    async def send_reply(self, writer, future, lines, framed):
+        """Wait for a reply and send it to the client"""
+        streamed = False
+        if lines is not None:
+            while True:
+                line = await lines.get()
+                if line is None:
+                    break
+                streamed = True
+                writer.write(bytes(line + '\n', 'UTF-8'))
+                await writer.drain()
+
+        controller = await future
+        reply = controller.get_reply()
+        if framed or lines is not None:
+            writer.write(frame_reply(reply, self.terminator, streamed))
+        elif reply:
+            writer.write(bytes(reply, 'UTF-8'))
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        if self.keepalive:
+            await self.handle_keepalive(reader, writer)
+            return
+
+        # We use a newline character as terminator for our input
+        # This means every query needs to be terminated by a newline!
+        try:
+            data = await reader.readuntil(b'\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            # Connection might be terminated early by client
+            writer.close()
+            return
+
+        controller, future, lines = self.submit(str(data, 'UTF-8', 'replace'))
+        watcher = asyncio.ensure_future(self._watch(reader, controller))
+        try:
+            await self.send_reply(writer, future, lines, False)
+        except ConnectionError:
+            pass
+        finally:
+            watcher.cancel()
+            writer.close()
+
+    async def _watch(self, reader, controller):
+        """Cancel the request as soon as the connection breaks. A client
+        which only closed its sending side still waits for the reply,
+        unless cancel_on_eof is set.
+        """
+        try:
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            controller.cancel()
+            return
+        if self.cancel_on_eof:
+            controller.cancel()
+
+    async def handle_keepalive(self, reader, writer):
+        """Read queries until the client closes the connection. Every query
+        is passed on right away, the replies are sent in request order.
+        """
+        pending = asyncio.Queue(self.pipeline)
+        sender = asyncio.ensure_future(self._send_replies(pending, writer))
+        inflight = []
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b'\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    # No more queries, but the client waits for the replies
+                    break
+                except ConnectionError:
+                    # The client is gone
+                    for controller in inflight:
+                        controller.cancel()
+                    break
+                item = self.submit(str(data, 'UTF-8', 'replace'))
+                inflight = [c for c in inflight if not c.is_ready()] + [item[0]]
+                await pending.put(item)
+        finally:
+            await pending.put(None)
+            await sender
+            writer.close()
+
+    async def _send_replies(self, pending, writer):
+        connected = True
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            if not connected:
+                item[0].cancel()
+                continue
+            try:
+                await self.send_reply(writer, item[1], item[2], True)
+            except ConnectionError:
+                connected = False
+
+def _set_result(future, result):
+    # The future is cancelled if the client went away in the meantime.
+    if not future.done():
+        future.set_result(result)
 
 class RequestHandler(socketserver.BaseRequestHandler):
 
@@ -39,6 +239,10 @@ class RequestHandler(socketserver.BaseRequestHandler):
 
     # Handle a request and stick the query into the queue.
     def handle(self):
+        if self.server.keepalive:
+            self.handle_keepalive()
+            return
+
         # We use a newline character as terminator for our input
         # This means every query needs to be terminated by a newline!
         query = ''
@@ -59,16 +263,114 @@ class RequestHandler(socketserver.BaseRequestHandler):
             # Controller object which is passed to the 
             # TODO: It would be a lot easier to pass on the tcp client (request) itself
             # But at the moment this feels cleaner.
-            controller = RequestController(query) 
-            self.callback(controller)
-            
-            # Wait for a Maxima worker thread to process our input 
-            controller.wait()
+            controller, lines = self.submit(query)
 
-            reply = controller.get_reply()
-            if reply:
-                self.request.sendall(bytes(controller.get_reply(), 'UTF-8'))
+            # Wait for a Maxima worker thread to process our input 
+            try:
+                self.send_reply(controller, lines, False, watch=True)
+            except OSError:
+                pass
             del controller
             
         self.request.close()
 
+    def submit(self, query):
+        """Pass a query on to the Maxima workers. In streaming mode, we
+        also return a queue which gets the output lines followed by None.
+        """
+        controller = RequestController(query)
+        lines = None
+        if self.server.streaming:
+            lines = queue.Queue()
+            controller.stream = lines.put
+            controller.add_done_callback(lambda c: lines.put(None))
+        self.callback(controller)
+        return controller, lines
+
+    def send_reply(self, controller, lines, framed, watch=False):
+        """Wait for a reply and send it to the client. If watch is set, the
+        request is cancelled as soon as the client disconnects.
+        """
+        poll = DISCONNECT_POLL if watch else None
+        streamed = False
+        if lines is not None:
+            while True:
+                try:
+                    line = lines.get(timeout=poll)
+                except queue.Empty:
+                    self.check_client(controller)
+                    continue
+                if line is None:
+                    break
+                streamed = True
+                self.request.sendall(bytes(line + '\n', 'UTF-8'))
+
+        while not controller.wait(poll):
+            self.check_client(controller)
+        reply = controller.get_reply()
+        if framed or lines is not None:
+            self.request.sendall(frame_reply(reply, self.server.terminator, streamed))
+        elif reply:
+            self.request.sendall(bytes(reply, 'UTF-8'))
+
+    def check_client(self, controller):
+        """Cancel the request if the connection broke. If the client only
+        closed its sending side, it still waits for the reply, unless
+        cancel_on_eof is set.
+        """
+        try:
+            readable, _, _ = select.select([self.request], [], [], 0)
+            if not readable or self.request.recv(1, socket.MSG_PEEK) or \
+                    not self.server.cancel_on_eof:
+                return
+        except OSError:
+            pass
+        controller.cancel()
+
+    def handle_keepalive(self):
+        """Read queries until the client closes the connection. Every query
+        is passed on right away, a second thread sends the replies in
+        request order.
+        """
+        pending = queue.Queue(self.server.pipeline)
+        sender = threading.Thread(target=self._send_replies, args=(pending,))
+        sender.start()
+
+        data = b''
+        inflight = []
+        try:
+            while True:
+                # An empty chunk means there are no more queries, but the
+                # client waits for the replies
+                chunk = self.request.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+                # Everything after the last newline is an incomplete query
+                *lines, data = data.split(b'\n')
+                for line in lines:
+                    item = self.submit(str(line + b'\n', 'UTF-8', 'replace'))
+                    inflight = [c for c in inflight if not c.is_ready()] + [item[0]]
+                    pending.put(item)
+        except OSError:
+            # The client is gone
+            for controller in inflight:
+                controller.cancel()
+        finally:
+            pending.put(None)
+            sender.join()
+            self.request.close()
+
+    def _send_replies(self, pending):
+        connected = True
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if not connected:
+                item[0].cancel()
+                continue
+            try:
+                self.send_reply(item[0], item[1], True)
+            except OSError:
+                connected = False
@@ -0,0 +1,214 @@
+import unittest
+import socket
+import struct
+import threading
+import time
+
+from tcp_server import ThreadedTCPServer, AsyncTCPServer, RequestHandler
+
+
+def echo_callback(controller):
+    """ Stands in for the Maxima workers and replies with the query """
+    controller.set_reply(controller.request.strip())
+    controller.set_ready()
+
+
+def slow_callback(controller):
+    """ Replies after the number of milliseconds given in the query,
+    so later queries can be ready before earlier ones.
+    """
+    delay = int(controller.request.strip().rstrip(';')) / 1000
+    threading.Timer(delay, echo_callback, args=(controller,)).start()
+
+
+def send_query(address, data):
+    client = socket.create_connection(address)
+    client.sendall(data)
+    reply = b''
+    while True:
+        chunk = client.recv(1024)
+        if not chunk:
+            break
+        reply += chunk
+    client.close()
+    return str(reply, 'UTF-8')
+
+
+def streaming_callback(controller):
+    """ Streams every character of the query as a line of its own """
+    def reply():
+        for char in controller.request.strip():
+            controller.stream(char)
+        echo_callback(controller)
+    threading.Thread(target=reply).start()
+
+
+class KeepaliveTests():
+    """ Tests for keep-alive connections, mixed into the tests of both servers """
+
+    def testPipelinedReplies(self):
+        self.server.keepalive = True
+        self.callback = slow_callback
+        client = socket.create_connection(self.address)
+        client.sendall(b'50;\n20;\n0;\n')
+        client.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            reply += chunk
+        client.close()
+        self.assertEqual(reply, b'50;\n;END;\n20;\n;END;\n0;\n;END;\n')
+
+    def testConcurrentDispatch(self):
+        self.server.keepalive = True
+        self.callback = slow_callback
+        client = socket.create_connection(self.address)
+        start = time.monotonic()
+        client.sendall(b'200;\n200;\n200;\n')
+        reply = b''
+        while reply.count(b';END;') < 3:
+            reply += client.recv(1024)
+        client.close()
+        # The queries were processed at the same time
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def _cancel_callback(self):
+        cancelled = threading.Event()
+        def cancel(controller):
+            cancelled.set()
+            echo_callback(controller)
+        self.callback = lambda controller: controller.set_on_cancel(lambda: cancel(controller))
+        return cancelled
+
+    def testCancelOnDisconnect(self):
+        cancelled = self._cancel_callback()
+        client = socket.create_connection(self.address)
+        # Close with a reset, like a client which crashed
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        client.sendall(b'12^12^12^12;\n')
+        time.sleep(.1)
+        client.close()
+        self.assertTrue(cancelled.wait(2))
+
+    def testCancelOnEof(self):
+        self.server.cancel_on_eof = True
+        cancelled = self._cancel_callback()
+        client = socket.create_connection(self.address)
+        client.sendall(b'12^12^12^12;\n')
+        client.shutdown(socket.SHUT_WR)
+        self.assertTrue(cancelled.wait(2))
+        client.close()
+
+    def testHalfClose(self):
+        # Like nc -N, the client closes its sending side after the query
+        def callback(controller):
+            # Like a worker, answer a cancelled request with an error
+            def cancel():
+                controller.set_reply(';ERR;CANCELLED')
+                controller.set_ready()
+            controller.set_on_cancel(cancel)
+            slow_callback(controller)
+        self.callback = callback
+        client = socket.create_connection(self.address)
+        client.sendall(b'300;\n')
+        client.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            reply += chunk
+        client.close()
+        self.assertEqual(reply, b'300;')
+
+    def testStreaming(self):
+        self.server.streaming = True
+        self.callback = streaming_callback
+        self.assertEqual(send_query(self.address, b'2^3;\n'), '2\n^\n3\n;\n;END;\n')
+
+    def testStreamingKeepalive(self):
+        self.server.keepalive = True
+        self.server.streaming = True
+        self.callback = streaming_callback
+        client = socket.create_connection(self.address)
+        client.sendall(b'x;\ny;\n')
+        client.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            reply += chunk
+        client.close()
+        self.assertEqual(reply, b'x\n;\n;END;\ny\n;\n;END;\n')
+
+    def testStreamingWithoutOutput(self):
+        self.server.streaming = True
+        self.assertEqual(send_query(self.address, b'12+12;\n'), '12+12;\n;END;\n')
+
+
+class ThreadedTCPServerTests(KeepaliveTests, unittest.TestCase):
+
+    def setUp(self):
+        self.callback = echo_callback
+        callback = lambda controller: self.callback(controller)
+        get_handler = lambda *args, **keys: RequestHandler(callback, *args, **keys)
+        self.server = ThreadedTCPServer(('localhost', 0), get_handler)
+        self.address = self.server.server_address
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testReply(self):
+        self.assertEqual(send_query(self.address, b'12+12;\n'), '12+12;')
+
+
+class AsyncTCPServerTests(KeepaliveTests, unittest.TestCase):
+
+    def setUp(self):
+        self.callback = echo_callback
+        self.server = AsyncTCPServer(('localhost', 0), lambda controller: self.callback(controller))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.server.started.wait()
+        self.address = self.server.server.sockets[0].getsockname()[:2]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(5)
+
+    def testReply(self):
+        self.assertEqual(send_query(self.address, b'12+12;\n'), '12+12;')
+
+    def testSplitQuery(self):
+        client = socket.create_connection(self.address)
+        client.sendall(b'2^')
+        client.sendall(b'3;\n')
+        self.assertEqual(client.recv(1024), b'2^3;')
+        client.close()
+
+    def testManyClients(self):
+        clients = [socket.create_connection(self.address) for i in range(200)]
+        for i, client in enumerate(clients):
+            client.sendall(bytes('%d;\n' % i, 'UTF-8'))
+        for i, client in enumerate(clients):
+            self.assertEqual(client.recv(1024), bytes('%d;' % i, 'UTF-8'))
+            client.close()
+
+    def testEarlyClose(self):
+        client = socket.create_connection(self.address)
+        client.sendall(b'12+12;')
+        client.close()
+        # The server is still working
+        self.assertEqual(send_query(self.address, b'1;\n'), '1;')
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# Helpers shared by the tests which need a Maxima
+
+import os
+
+from config_loader import Config
+from maxima_pool import MaximaPool
+from maxima_threads import MaximaWorker, RequestQueue
+
+
+def maxima_config():
+    """Return the [Maxima] section as a dict. The tests run against
+    another Maxima, e.g. fake_maxima.py, if TCP2MAXIMA_PATH is set, and
+    with another timeout if TCP2MAXIMA_TIMEOUT is set.
+    """
+    config = Config()
+    for key in ('path', 'timeout'):
+        if 'TCP2MAXIMA_' + key.upper() in os.environ:
+            config['Maxima'][key] = os.environ['TCP2MAXIMA_' + key.upper()]
+    return dict(config['Maxima'])
+
+
+def start_worker(test, name, config, queries=None, **keys):
+    """Start a worker for its own queue or for queries. It's quit when
+    the test is over, even if an assertion failed.
+    """
+    if queries is None:
+        queries = RequestQueue()
+    worker = MaximaWorker(name, queries, config, **keys)
+    test.addCleanup(quit_worker, worker)
+    worker.start()
+    return worker
+
+
+def quit_worker(worker):
+    """Quit a worker and wait until it's gone"""
+    if worker.is_alive():
+        worker.quit_worker()
+        worker.join()
+
+
+def start_pool(test, config, queries=None, **keys):
+    """Start the workers of a pool. The pool is quit when the test is
+    over, even if an assertion failed.
+    """
+    if queries is None:
+        queries = RequestQueue()
+    pool = MaximaPool(queries, config, **keys)
+    test.addCleanup(pool.quit)
+    pool.start_workers()
+    return pool